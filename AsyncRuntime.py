@@ -0,0 +1,436 @@
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, CancelledError, ThreadPoolExecutor, wait
+from itertools import islice
+from threading import Event, Lock, Thread
+
+import aiohttp
+from telegram import Update
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, Unauthorized
+from yarl import URL
+
+import Delivery
+import Http
+import Retry
+import Webhook
+
+CHAT_BATCH = 1000       # chats read at once on the thread of a broadcast
+
+
+def proxy_kwargs(proxy):
+    '''aiohttp arguments of requests through `proxy-info`. aiohttp only
+    connects through http proxies, the credentials are taken from the url or
+    username and password of urllib3_proxy_kwargs.'''
+    if not proxy or not proxy.get('proxy_url'):
+        return dict()
+    url = URL(proxy['proxy_url'])
+    if url.scheme != 'http':
+        raise RuntimeError(f'{url.scheme} proxies are not supported by asyncio runtime, use an http proxy or threads runtime')
+    options = proxy.get('urllib3_proxy_kwargs') or dict()
+    kwargs = {'proxy': str(url.with_user(None))}
+    if url.user is not None or 'username' in options:
+        kwargs['proxy_auth'] = aiohttp.BasicAuth(options.get('username', url.user or ''), options.get('password', url.password or ''))
+    if options.get('proxy_headers'):
+        kwargs['proxy_headers'] = options['proxy_headers']
+    return kwargs
+
+
+class AsyncTokenBucket:
+    'Same as Delivery.TokenBucket but waits without blocking the event loop'
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def consume(self, tokens=1):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def set_rate(self, rate, empty=False):
+        now = time.monotonic()
+        self.tokens = 0 if empty else min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.rate = rate
+
+
+class AsyncRuntime:
+    '''Run polling, feed checks and broadcasts on a single event loop.
+
+    Updates are received with long polling (or a webhook) and handed to the dispatcher, which
+    keeps running the handlers on its own threads. Sources are downloaded
+    with aiohttp, parsed on a small pool of threads and new feeds are sent
+    with bot API requests on the loop, so thousands of in-flight messages do
+    not need thousands of threads.
+    '''
+
+    def __init__(self, server, in_flight=256, feed_workers=4, proxy=None):
+        self.server = server
+        self.in_flight = in_flight
+        self.feed_workers = feed_workers
+        self.proxy = proxy
+        self.proxy_kwargs = dict()
+        self.api_url = f'{server.bot.base_url}/'
+        self.delivery = server.delivery
+        self.global_bucket = None
+        self.resumed = 0
+        self.loop = None
+        self.main_task = None
+        self.wakeup = None
+        self.ready = Event()        # set when the loop can send feeds
+        self.broadcasts = set()     # tasks of send_feed_threadsafe
+        self.stopping = False       # no new broadcasts are started
+        self.submit_lock = Lock()
+        # parsing and rendering feeds, separated from the default executor that
+        # runs short blocking calls, so a running check can never starve them
+        self.checks = ThreadPoolExecutor(feed_workers, 'feeds')
+        self.running_checks = set()     # futures of self.checks
+        self.thread = Thread(target=self.__thread, name='async-runtime')
+        self.dispatcher_thread = Thread(target=server.dispatcher.start, name='dispatcher')
+        self.logger = logging.getLogger('RSSBot')
+
+    def start(self, sources, polling=True):
+        self.proxy_kwargs = proxy_kwargs(self.proxy)
+        self.sources = sources
+        self.polling = polling
+        self.dispatcher_thread.start()
+        self.thread.start()
+
+    def __thread(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.main_task = self.loop.create_task(self.__main())
+            self.loop.run_until_complete(self.main_task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            with self.submit_lock:
+                self.stopping = True
+            self.ready.set()
+            self.checks.shutdown(wait=True)
+            self.loop.run_until_complete(self.loop.shutdown_default_executor())
+            self.loop.close()
+
+    async def __main(self):
+        self.wakeup = asyncio.Event()
+        self.global_bucket = AsyncTokenBucket(self.delivery.global_bucket.rate, self.delivery.global_bucket.capacity)
+        connector = aiohttp.TCPConnector(limit=self.in_flight)
+        async with aiohttp.ClientSession(connector=connector) as self.session:
+            self.ready.set()
+            tasks = [asyncio.create_task(self.check_loop(source)) for source in self.sources]
+            if self.polling:
+                tasks.append(asyncio.create_task(self.poll()))
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await self.stop_broadcasts()
+
+    async def stop_broadcasts(self):
+        '''Cancel broadcasts and wait for feed checks to return. A check may
+        wait for a broadcast on this loop, so it must keep running until then.'''
+        with self.submit_lock:
+            self.stopping = True
+        for task in list(self.broadcasts):
+            task.cancel()
+        checks = [asyncio.wrap_future(future) for future in list(self.running_checks)]
+        await asyncio.gather(*checks, return_exceptions=True)
+
+    def reschedule(self):
+        'Wake up all sources so they wait for the new interval'
+        if self.loop and self.wakeup:
+            self.loop.call_soon_threadsafe(self.__wake)
+
+    def __wake(self):
+        wakeup, self.wakeup = self.wakeup, asyncio.Event()
+        wakeup.set()
+
+    def idle(self):
+        Webhook.wait_for_signal()
+        self.stop()
+
+    def stop(self):
+        if self.loop and self.main_task:
+            self.loop.call_soon_threadsafe(self.main_task.cancel)
+        if self.thread.is_alive():
+            self.thread.join()
+        self.server.dispatcher.stop()
+        if self.dispatcher_thread.is_alive():
+            self.dispatcher_thread.join()
+
+    async def api(self, method, payload, timeout=None):
+        'Call a bot API method and raise the same errors as python-telegram-bot'
+        try:
+            async with self.session.post(
+                    self.api_url + method,
+                    data=payload if isinstance(payload, bytes) else json.dumps(payload),
+                    headers={'Content-Type': 'application/json'},
+                    **self.proxy_kwargs,
+                    timeout=aiohttp.ClientTimeout(total=timeout or 30)) as response:
+                data = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise NetworkError(str(e)) from e
+        if data.get('ok'):
+            return data['result']
+        description = data.get('description', 'Unknown error')
+        code = data.get('error_code')
+        if code == 429:
+            raise RetryAfter(data.get('parameters', dict()).get('retry_after', 1))
+        if code in (401, 403):
+            raise Unauthorized(description)
+        if code == 400:
+            raise BadRequest(description)
+        raise TelegramError(description)
+
+    async def poll(self):
+        # getUpdates fails while a webhook is set, Updater.start_polling deletes it too
+        while True:
+            try:
+                await self.api('deleteWebhook', {'drop_pending_updates': False})
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.logger.exception('Exception while deleting the webhook')
+                await asyncio.sleep(3)
+        offset = None
+        while True:
+            try:
+                updates = await self.api('getUpdates', {'offset': offset, 'timeout': 30}, timeout=40)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.logger.exception('Exception while getting updates')
+                await asyncio.sleep(3)
+                continue
+            for data in updates:
+                offset = data['update_id'] + 1
+                self.server.dispatcher.update_queue.put(Update.de_json(data, self.server.bot))
+
+    async def check_loop(self, source):
+        while True:
+            await self.check(source)
+            while True:
+                # a wakeup restarts waiting with the new interval
+                delay = source.breaker.next_check(source.interval or self.server.interval)
+                self.logger.info(f'Checking {source.url} for new feeds in {delay} seconds')
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    break
+
+    async def get_feeds(self, source):
+        server = self.server
+        cache = server.get_data(source.key('feed-cache'), dict(), DB = server.data_db)
+        headers = server.conditional_headers(cache) if 'body' in cache else None
+        source.breaker.check(source.url)
+        self.logger.info(f'Getting feeds from {source.url}')
+        try:
+            async with self.session.get(source.url, headers=headers, **self.proxy_kwargs,
+                    timeout=aiohttp.ClientTimeout(total=server.retry.timeout)) as response:
+                if response.status == 304 and headers:
+                    source.breaker.success()
+                    return server.feeds_not_modified(source, cache, True)
+                response.raise_for_status()
+                body = (await self.read_body(response, server.http.max_size)).decode('utf-8')
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            source.breaker.failure()
+            raise
+        source.breaker.success()
+        return server.feeds_modified(source, body, response.headers, True)
+
+    async def read_body(self, response, max_size):
+        'Same size limit as Http.HttpResponse, aiohttp decodes the response'
+        if max_size and (response.content_length or 0) > max_size:
+            raise Http.ResponseTooLarge(f'{response.url} is {response.content_length} bytes, more than {max_size}', response.status)
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(Http.CHUNK_SIZE):
+            body += chunk
+            if max_size and len(body) > max_size:
+                raise Http.ResponseTooLarge(f'{response.url} is larger than {max_size} bytes', response.status)
+        return bytes(body)
+
+    async def check(self, source):
+        try:
+            feeds_page, modified = await self.get_feeds(source)
+        except asyncio.CancelledError:
+            raise
+        except Retry.CircuitOpen as e:
+            self.logger.warning(str(e))
+            return
+        except Exception as e:
+            await self.run(self.server.log_bug, e, 'exception while trying to get feeds', False, True, source=source.url)
+            return
+        if modified:
+            future = self.checks.submit(self.server.check_new_feed, source, feeds_page)
+            self.running_checks.add(future)
+            future.add_done_callback(self.running_checks.discard)
+            await asyncio.wrap_future(future)
+
+    async def throttle(self):
+        'Same as DeliveryEngine.throttle'
+        flood = self.delivery.flood
+        while True:
+            pause = flood.pause()
+            while pause:
+                await asyncio.sleep(pause)
+                pause = flood.pause()
+            rate = flood.rate()
+            if flood.paused_until != self.resumed:
+                self.resumed = flood.paused_until
+                self.global_bucket.set_rate(rate, empty=True)
+            elif rate != self.global_bucket.rate:
+                self.global_bucket.set_rate(rate)
+            await self.global_bucket.consume()
+            if not flood.pause():
+                return
+
+    async def send(self, request, bucket):
+        'Same as DeliveryEngine.send, `request` returns an awaitable'
+        for attempt in range(Delivery.MAX_RETRIES + 1):
+            await bucket.consume()
+            await self.throttle()
+            try:
+                result = await request()
+            except RetryAfter as e:
+                self.delivery.flood.retry_after(e.retry_after)
+                if attempt == Delivery.MAX_RETRIES:
+                    raise
+                continue
+            self.delivery.flood.success()
+            return result
+
+    async def run(self, func, *args, **kwargs):
+        'Run a blocking function on the executor'
+        return await self.loop.run_in_executor(None, lambda: func(*args, **kwargs))
+
+    def send_feed_threadsafe(self, messages, chats, job=None):
+        '''Broadcast from another thread and wait for it to finish. Returns
+        False if the runtime stopped before it was done. Chats are read on the
+        calling thread in batches of CHAT_BATCH, the next one when the loop has
+        taken the previous one.'''
+        self.ready.wait()
+        batches = asyncio.Queue(1)
+        future = self.__submit(self.__broadcast(messages, self.__batches(batches), job))
+        if future is None:
+            return False
+        chats = iter(chats)
+        while not future.done():
+            batch = list(islice(chats, CHAT_BATCH))
+            put = self.__submit(batches.put(batch or None))
+            if put is None:
+                break
+            wait((put, future), return_when=FIRST_COMPLETED)
+            put.cancel()        # the broadcast ended without taking it
+            if not batch:
+                break
+        try:
+            return future.result()
+        except CancelledError:
+            self.logger.warning('Broadcast is stopped before it was done')
+            return False
+
+    def __submit(self, coro):
+        'Run coro on the loop, None if the runtime is stopping'
+        with self.submit_lock:
+            if self.stopping:
+                coro.close()
+                return None
+            return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def __batches(self, batches):
+        while (batch := await batches.get()) is not None:
+            for chat in batch:
+                yield chat
+
+    async def __broadcast(self, messages, chats, job):
+        if self.stopping:
+            return False
+        task = asyncio.current_task()
+        self.broadcasts.add(task)
+        try:
+            return await self.send_feed(messages, chats, job)
+        finally:
+            self.broadcasts.discard(task)
+
+    async def send_feed(self, messages, chats, job=None):
+        server = self.server
+        deathlist = []
+        file_ids = await self.run(server.stored_file_ids, messages)
+
+        def stored(src, file_id):
+            if file_id:
+                server.set_data(server.file_key(src), file_id, DB = server.files_db, batch = True)
+            else:
+                server.delete_data(server.file_key(src), DB = server.files_db, batch = True)
+
+        async def blocked(chat_id, chat_data, e):
+            await self.run(server.log_bug, e, 'handled an exception while sending a feed to a user. removing chat', report=False, chat_id = chat_id, chat_data = chat_data)
+            deathlist.append(chat_id)
+
+        async def failed(chat_id, chat_data, msg, e):
+            await self.run(server.log_bug, e, 'Exception while sending a feed to a user', message = msg, chat_id = chat_id, chat_data = chat_data)
+
+        sender = Delivery.AsyncFeedSender(
+            messages, file_ids, lambda template, chat_id: self.api(template.method, template.body(chat_id), timeout=template.timeout),
+            stored, blocked, failed)
+
+        async def deliver(chat_id, chat_data):
+            bucket = self.delivery.chat_bucket(chat_data)
+            bucket = AsyncTokenBucket(bucket.rate, bucket.capacity)
+            return await sender.deliver(chat_id, chat_data, lambda request: self.send(request, bucket))
+
+        stats = {'chats': 0, 'messages': 0, 'failed': 0}
+        slots = asyncio.Semaphore(self.in_flight)
+
+        async def task(chat_id, chat_data):
+            try:
+                sent = await deliver(chat_id, chat_data)
+            finally:
+                slots.release()
+            if job is not None:
+                job.complete(chat_id)
+            stats['chats'] += 1
+            if sent is None:
+                stats['failed'] += 1
+            else:
+                stats['messages'] += sent
+
+        start = time.monotonic()
+        tasks = set()
+        try:
+            async for chat_id, chat_data in chats:
+                await slots.acquire()
+                t = asyncio.create_task(task(chat_id, chat_data))
+                tasks.add(t)
+                t.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            # chats that are not done are sent when the job resumes
+            for t in list(tasks):
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            for chat_id in deathlist:
+                server.delete_chat(chat_id, batch = True)
+            await self.run(server.writes.flush)
+
+        stats['elapsed'] = time.monotonic() - start
+        stats['rate'] = stats['messages'] / stats['elapsed'] if stats['elapsed'] else 0
+        self.delivery.log_stats(stats)
+        return stats
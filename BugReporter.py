@@ -113,9 +113,11 @@ def exception(custom_msg='', exc_info=None, report = True, **args):
     f = s[0]
     lineno = f.lineno
     filename = os.path.basename(f.filename)
+    tag = f'L{lineno}@{filename}: {exception_type.__name__}'
     if report:
-        bug(f'L{lineno}@{filename}: {exception_type.__name__}', f'{custom_msg}\n{tb_string}', line=lineno, file=filename, **args)
+        bug(tag, f'{custom_msg}\n{tb_string}', line=lineno, file=filename, **args)
     return {
+        'tag'      : tag,
         'exc_type'  : exception_type,
         'line_no'  : lineno,
         'file_name': filename,
@@ -0,0 +1,88 @@
+import pickle
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    '''A thread-safe least recently used cache.
+
+    If an lmdb `env` and `db` are given, entries are also stored in that
+    database and loaded back on start, so they survive restarts. Evicted
+    entries are removed from the database too, so it never grows beyond
+    `size` entries.
+    '''
+
+    def __init__(self, size=128, env=None, db=None):
+        self.size = size
+        self.env = env
+        self.db = db
+        self.items = OrderedDict()
+        self.lock = Lock()
+        if db is not None:
+            with env.begin(db) as txn:
+                stored = [(key.decode(), pickle.loads(value)) for key, value in txn.cursor()]
+            for key, value in stored:
+                self.__put(key, value)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+        return default
+
+    def put(self, key, value):
+        if self.db is not None:
+            with self.env.begin(self.db, write=True) as txn:
+                txn.put(key.encode(), pickle.dumps(value))
+        self.__put(key, value)
+
+    def __put(self, key, value):
+        evicted = []
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                evicted.append(self.items.popitem(last=False)[0])
+        if evicted and self.db is not None:
+            with self.env.begin(self.db, write=True) as txn:
+                for key in evicted:
+                    txn.delete(key.encode())
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+        if self.db is not None:
+            with self.env.begin(self.db, write=True) as txn:
+                txn.drop(self.db, delete=False)
+
+
+class Snapshot:
+    '''A value that expires `ttl` seconds after it was set.
+
+    On a miss only one caller runs `load`, concurrent callers wait for it and
+    get the same value instead of loading it again.
+    '''
+
+    def __init__(self, load, ttl=300):
+        self.load = load
+        self.ttl = ttl
+        self.value = None
+        self.expires = 0
+        self.lock = Lock()
+
+    def get(self):
+        if time.monotonic() < self.expires:
+            return self.value
+        with self.lock:
+            if time.monotonic() < self.expires:
+                return self.value       # loaded by another caller
+            value = self.load()
+            if value is not None:
+                self.set(value)
+            return value
+
+    def set(self, value):
+        self.value = value
+        self.expires = time.monotonic() + self.ttl
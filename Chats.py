@@ -0,0 +1,158 @@
+'''Compact binary records of chats in the `chats` sub-db
+
+A record is a fixed header (version, type, flags, id, members-count), then
+the length-prefixed string fields and finally an optional json blob with any
+other field. Header fields can be read without decoding the rest of the record.
+'''
+import json
+import logging
+import pickle
+import struct
+import zlib
+
+VERSION = 1
+TYPES = ('private', 'group', 'supergroup', 'channel')
+OTHER_TYPE = 255
+HEADER = struct.Struct('<BBBqi')       # version, type, flags, id, members-count
+LENGTH = struct.Struct('<H')
+STRING_FIELDS = ('title', 'username', 'first_name', 'last_name', 'language_code')
+# each boolean field uses two bits of flags: is present, value
+BOOL_FIELDS = ('is_bot',)
+FIXED_FIELDS = ('type', 'id', 'members-count') + STRING_FIELDS + BOOL_FIELDS
+MIGRATE_BATCH = 1000
+
+
+def encode(data: dict) -> bytes:
+    chat_type = data.get('type')
+    type_code = TYPES.index(chat_type) if chat_type in TYPES else OTHER_TYPE
+    extras = {k: v for k, v in data.items() if k not in FIXED_FIELDS and v is not None}
+    if type_code == OTHER_TYPE and chat_type is not None:
+        extras['type'] = chat_type
+    flags = 0
+    for i, field in enumerate(BOOL_FIELDS):
+        if isinstance(data.get(field), bool):
+            flags |= (1 | data[field] << 1) << (i*2)
+        elif data.get(field) is not None:
+            extras[field] = data[field]
+    parts = [HEADER.pack(VERSION, type_code, flags, int(data.get('id', 0)), int(data.get('members-count', 0)))]
+    for field in STRING_FIELDS:
+        value = (data.get(field) or '').encode()
+        parts.append(LENGTH.pack(len(value)))
+        parts.append(value)
+    if extras:
+        parts.append(json.dumps(extras, ensure_ascii=False, separators=(',', ':'), default=str).encode())
+    return b''.join(parts)
+
+
+def decode_header(value) -> dict:
+    'Decode only id, type and members-count of a record'
+    version, type_code, flags, chat_id, members = HEADER.unpack_from(value)
+    if version != VERSION:
+        raise ValueError(f'unknown chat record version {version}')
+    return {
+        'id': chat_id,
+        'type': TYPES[type_code] if type_code < len(TYPES) else None,
+        'members-count': members
+    }
+
+
+def decode(value) -> dict:
+    value = bytes(value)
+    data = decode_header(value)
+    flags = value[2]
+    if flags:
+        for i, field in enumerate(BOOL_FIELDS):
+            if flags >> (i*2) & 1:
+                data[field] = bool(flags >> (i*2+1) & 1)
+    offset = HEADER.size
+    for field in STRING_FIELDS:
+        length = value[offset] | value[offset+1] << 8
+        offset += 2
+        if length:
+            data[field] = value[offset:offset+length].decode()
+            offset += length
+    if offset < len(value):
+        data.update(json.loads(value[offset:]))
+    return data
+
+
+def is_legacy(value) -> bool:
+    return bytes(value[:1]) != bytes((VERSION,))
+
+
+def migrate(env, db):
+    '''Convert pickled chat records of older versions, returns (converted, removed)
+
+    This is the only place that still unpickles chat records.'''
+    legacy = []
+    with env.begin(db) as txn:
+        for key, value in txn.cursor():
+            if is_legacy(value):
+                legacy.append((key, value))
+    if not legacy:
+        return 0, 0
+
+    converted, removed = 0, 0
+    for start in range(0, len(legacy), MIGRATE_BATCH):
+        with env.begin(db, write=True) as txn:
+            for key, value in legacy[start:start+MIGRATE_BATCH]:
+                try:
+                    data = pickle.loads(value)
+                except Exception:
+                    data = None
+                if isinstance(data, dict):
+                    txn.put(key, encode(data))
+                    converted += 1
+                else:
+                    txn.delete(key)
+                    removed += 1
+    logging.getLogger('RSSBot').info(f'Migrated {converted} chat records, removed {removed} bad records')
+    return converted, removed
+
+
+STATS_KEY = b'chat-stats'
+
+
+def shard_of(chat_id, shards) -> int:
+    'Shard of a chat when chats are split between `shards` sender processes'
+    return zlib.crc32(str(chat_id).encode()) % shards
+
+
+def empty_stats():
+    return {'chats': 0, 'members': 0, 'types': dict()}
+
+
+def update_stats(stats, old=None, new=None):
+    'Replace the `old` record with the `new` one in stats, both could be None'
+    for value, sign in ((old, -1), (new, 1)):
+        if value is None:
+            continue
+        try:
+            header = decode_header(value)
+        except Exception:
+            continue    # bad records are not counted
+        stats['chats'] += sign
+        stats['members'] += sign * header['members-count']
+        chat_type = header['type'] or 'other'
+        stats['types'][chat_type] = stats['types'].get(chat_type, 0) + sign
+    return stats
+
+
+def get_stats(txn, data_db):
+    value = txn.get(STATS_KEY, db=data_db)
+    return pickle.loads(value) if value is not None else None
+
+
+def put_stats(txn, data_db, stats):
+    txn.put(STATS_KEY, pickle.dumps(stats), db=data_db)
+
+
+def rebuild_stats(env, db, data_db):
+    'Count all chats again and store the result'
+    with env.begin(write=True) as txn:
+        stats = empty_stats()
+        for key, value in txn.cursor(db=db):
+            update_stats(stats, new=value)
+        put_stats(txn, data_db, stats)
+    logging.getLogger('RSSBot').info(f'Chat stats rebuilt: {stats}')
+    return stats
@@ -0,0 +1,462 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+
+from telegram import Chat, InlineKeyboardMarkup, InputMediaPhoto, ParseMode
+from telegram.error import BadRequest, RetryAfter, Unauthorized
+from telegram.utils.request import Timeout     # vendored urllib3 or the installed one
+
+# Telegram limits (https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this)
+# - about 30 messages per second overall
+# - about one message per second in a single chat
+# - no more than 20 messages per minute in a group or channel
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+GROUP_RATE = 20/60
+# a request that telegram asks to retry later is sent again at most this many times
+MAX_RETRIES = 5
+
+
+def images_of(msg):
+    'Images of a rendered message, the photos of an album or the message itself'
+    if msg['type'] == 'album':
+        return msg['images']
+    return [msg] if msg['type'] == 'image' else []
+
+
+def album_media(msg, file_ids):
+    'InputMediaPhoto of each image of an album, with its file_id in `file_ids` (src => file_id) if it has one'
+    return [InputMediaPhoto(file_ids.get(img['src'], img['src']), img['text'] or None, parse_mode=ParseMode.HTML) for img in msg['images']]
+
+
+class RequestTemplate:
+    '''A bot API request that is the same for every chat but its chat_id.
+
+    The json body is encoded once, `body` only splices the chat_id in front
+    of it. `file_ids` are the file_ids it sends for the images of its message,
+    None for an image that is uploaded from its src.
+    '''
+
+    def __init__(self, method, payload, timeout=None, file_ids=()):
+        self.method = method
+        self.timeout = timeout
+        self.file_ids = file_ids
+        encoded = json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode()
+        self.tail = encoded[1:] if encoded == b'{}' else b',' + encoded[1:]
+
+    def body(self, chat_id):
+        return b'{"chat_id":' + json.dumps(chat_id).encode() + self.tail
+
+
+def request_template(msg, file_ids):
+    'RequestTemplate of a rendered message, with the file_ids its images have now'
+    # the same file_ids in the request and in template.file_ids, while other chats change them
+    file_ids = {img['src']: file_ids.get(img['src']) for img in images_of(msg)}
+    file_ids = {src: file_id for src, file_id in file_ids.items() if file_id}
+    sent = tuple(file_ids.get(img['src']) for img in images_of(msg))
+    markup = {'reply_markup': InlineKeyboardMarkup(msg['markup']).to_dict()} if msg['markup'] else dict()
+    if msg['type'] == 'text':
+        return RequestTemplate('sendMessage', dict(
+            text=msg['text'], parse_mode=ParseMode.HTML, disable_web_page_preview=True, **markup))
+    if msg['type'] == 'image':
+        caption = {'caption': msg['text'], 'parse_mode': ParseMode.HTML} if msg['text'] else dict()
+        return RequestTemplate('sendPhoto', dict(photo=file_ids.get(msg['src'], msg['src']), **caption, **markup), file_ids=sent)
+    # same timeout as Bot.send_media_group
+    return RequestTemplate('sendMediaGroup', {'media': [media.to_dict() for media in album_media(msg, file_ids)]}, timeout=20, file_ids=sent)
+
+
+class RequestTemplates:
+    '''RequestTemplates of the messages of a broadcast, a message is compiled
+    again only when its images get or lose a file_id'''
+
+    def __init__(self, file_ids):
+        self.file_ids = file_ids    # src => file_id
+        self.compiled = dict()      # id(msg) => template
+
+    def get(self, msg):
+        template = self.compiled.get(id(msg))
+        if template is None or template.file_ids != tuple(self.file_ids.get(img['src']) for img in images_of(msg)):
+            template = self.compiled[id(msg)] = request_template(msg, self.file_ids)
+        return template
+
+
+def post(bot, template, chat_id):
+    '''Send a RequestTemplate to a chat on the connection pool of a
+    python-telegram-bot Bot. Returns the json result and raises the same
+    errors as the methods of the Bot.'''
+    kwargs = dict()
+    if template.timeout:
+        kwargs['timeout'] = Timeout(read=template.timeout, connect=bot.request._connect_timeout)
+    result = bot.request._request_wrapper(
+        'POST',
+        f'{bot.base_url}/{template.method}',
+        body=template.body(chat_id),
+        headers={'Content-Type': 'application/json'},
+        **kwargs)
+    return bot.request._parse(result)
+
+
+class FeedSender:
+    '''Send the messages of a broadcast to a chat, for every runtime.
+
+    `file_ids` has the stored file_id of each image (src => file_id), the
+    messages are not changed so they can be shared with the render cache.
+    `post(template, chat_id)` sends a RequestTemplate and returns its json
+    result. `stored(src, file_id)` is called when an uploaded image gets a
+    file_id, and with None when its stored file_id is not valid anymore.
+    `blocked(chat_id, chat_data, error)` and `failed(chat_id, chat_data, msg,
+    error)` are called when a chat can not be sent to.
+
+    Each image is uploaded by a single chat at a time, the others wait for it
+    and send its file_id. A file_id that telegram does not accept is dropped
+    and its image uploaded again the same way, once, by the first chat that
+    sent it.
+    '''
+
+    new_lock = Lock
+
+    def __init__(self, messages, file_ids, post, stored, blocked, failed):
+        self.messages = messages
+        self.file_ids = file_ids
+        self.post = post
+        self.stored = stored
+        self.blocked = blocked
+        self.failed = failed
+        self.templates = RequestTemplates(file_ids)
+        self.uploads = {id(msg): self.new_lock() for msg in messages if images_of(msg)}
+        self.logger = logging.getLogger('RSSBot')
+
+    def uploaded(self, msg):
+        return all(img['src'] in self.file_ids for img in images_of(msg))
+
+    def deliver(self, chat_id, chat_data, send):
+        '''Send all messages to a chat, a `deliver` of DeliveryEngine.broadcast.
+        Returns number of sent messages or None if the chat failed.'''
+        sent = 0
+        for msg in self.messages:
+            try:
+                self.send_message(chat_id, msg, send)
+                sent += 1
+            except Unauthorized as e:
+                self.blocked(chat_id, chat_data, e)
+                return None
+            except Exception as e:
+                self.failed(chat_id, chat_data, msg, e)
+                return None
+        return sent
+
+    def send_message(self, chat_id, msg, send):
+        if msg['type'] == 'text':
+            send(lambda: self.post(self.templates.get(msg), chat_id))
+        elif self.uploaded(msg):
+            send(lambda: self.send_media(chat_id, msg))
+        else:
+            with self.uploads[id(msg)]:
+                send(lambda: self.send_media(chat_id, msg, locked=True))
+
+    def send_media(self, chat_id, msg, locked=False, retry=False):
+        template = self.templates.get(msg)
+        try:
+            result = self.post(template, chat_id)
+        except BadRequest:
+            if retry or not any(template.file_ids):
+                raise
+            if locked:
+                self.drop_file_ids(msg, template.file_ids)
+                return self.send_media(chat_id, msg, locked, retry=True)
+            with self.uploads[id(msg)]:
+                self.drop_file_ids(msg, template.file_ids)
+                return self.send_media(chat_id, msg, True, retry=True)
+        self.keep_file_ids(msg, template.file_ids, result)
+
+    def drop_file_ids(self, msg, sent):
+        '''Forget file_ids that telegram did not accept, `sent` are the file_ids
+        that were sent. A file_id that another chat already replaced is kept.'''
+        for img, file_id in zip(images_of(msg), sent):
+            if file_id and self.file_ids.get(img['src']) == file_id:
+                # file_id is not valid anymore, upload the image again
+                self.logger.warning(f'Stored file_id of {img["src"]} is not valid')
+                self.file_ids.pop(img['src'], None)
+                self.stored(img['src'], None)
+
+    def keep_file_ids(self, msg, sent, result):
+        '''Store file_ids of images that were uploaded, `result` is the sent
+        message of a photo or the list of sent messages of an album'''
+        for img, file_id, sent_msg in zip(images_of(msg), sent, result if isinstance(result, list) else [result]):
+            if file_id is None and sent_msg.get('photo'):
+                self.file_ids[img['src']] = sent_msg['photo'][-1]['file_id']
+                self.stored(img['src'], self.file_ids[img['src']])
+
+
+class AsyncFeedSender(FeedSender):
+    '''Same as FeedSender on an event loop, `post`, `blocked`, `failed` and
+    `send` of `deliver` return awaitables'''
+
+    new_lock = asyncio.Lock
+
+    async def deliver(self, chat_id, chat_data, send):
+        sent = 0
+        for msg in self.messages:
+            try:
+                await self.send_message(chat_id, msg, send)
+                sent += 1
+            except Unauthorized as e:
+                await self.blocked(chat_id, chat_data, e)
+                return None
+            except Exception as e:
+                await self.failed(chat_id, chat_data, msg, e)
+                return None
+        return sent
+
+    async def send_message(self, chat_id, msg, send):
+        if msg['type'] == 'text':
+            await send(lambda: self.post(self.templates.get(msg), chat_id))
+        elif self.uploaded(msg):
+            await send(lambda: self.send_media(chat_id, msg))
+        else:
+            async with self.uploads[id(msg)]:
+                await send(lambda: self.send_media(chat_id, msg, locked=True))
+
+    async def send_media(self, chat_id, msg, locked=False, retry=False):
+        template = self.templates.get(msg)
+        try:
+            result = await self.post(template, chat_id)
+        except BadRequest:
+            if retry or not any(template.file_ids):
+                raise
+            if locked:
+                self.drop_file_ids(msg, template.file_ids)
+                return await self.send_media(chat_id, msg, locked, retry=True)
+            async with self.uploads[id(msg)]:
+                self.drop_file_ids(msg, template.file_ids)
+                return await self.send_media(chat_id, msg, True, retry=True)
+        self.keep_file_ids(msg, template.file_ids, result)
+
+
+class TokenBucket:
+    'A thread-safe token bucket, `consume` blocks until enough tokens are available'
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def consume(self, tokens=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def set_rate(self, rate, empty=False):
+        'Change the rate, tokens that are saved are dropped if `empty` is true'
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = 0 if empty else min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = rate
+
+
+class FloodControl:
+    '''Adapt the overall rate to the flood limits that telegram reports.
+
+    A RetryAfter error pauses all sends for `retry_after` seconds and cuts the
+    rate by `decrease`, then the rate grows back by `recovery` messages per
+    second each second until it reaches `max_rate` or the next RetryAfter.
+    '''
+
+    def __init__(self, max_rate, min_rate=1, decrease=0.5, recovery=1, window=10):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.decrease = decrease
+        self.recovery = recovery
+        self.window = window
+        self.base_rate = max_rate       # rate right after the last RetryAfter
+        self.throttled = None           # time of the last RetryAfter
+        self.paused_until = 0
+        self.sent_times = deque()       # times of messages sent in the last `window` seconds
+        self.started = time.monotonic()
+        self.stats = {'sent': 0, 'retry-after': 0, 'paused': 0.0, 'ceiling': None}
+        self.lock = Lock()
+
+    def rate(self):
+        'Current target rate in messages per second'
+        if self.throttled is None:
+            return self.max_rate
+        return min(self.max_rate, self.base_rate + max(0, time.monotonic() - self.throttled) * self.recovery)
+
+    def pause(self):
+        'Seconds that all sends must wait'
+        return max(0, self.paused_until - time.monotonic())
+
+    def throughput(self):
+        'Messages per second in the last `window` seconds'
+        with self.lock:
+            return self.__throughput(time.monotonic())
+
+    def __throughput(self, now):
+        while self.sent_times and self.sent_times[0] < now - self.window:
+            self.sent_times.popleft()
+        return len(self.sent_times) / max(1, min(self.window, now - self.started))
+
+    def success(self):
+        now = time.monotonic()
+        with self.lock:
+            self.stats['sent'] += 1
+            self.sent_times.append(now)
+
+    def retry_after(self, seconds):
+        now = time.monotonic()
+        with self.lock:
+            self.stats['retry-after'] += 1
+            paused = now < self.paused_until
+            until = now + seconds
+            if until > self.paused_until:
+                self.stats['paused'] += until - max(now, self.paused_until)
+                self.paused_until = until
+            if paused:
+                return      # requests that were sent before the pause, the rate is already cut
+            # the throughput that telegram did not accept
+            self.stats['ceiling'] = self.__throughput(now)
+            self.base_rate = max(self.min_rate, self.rate() * self.decrease)
+            self.throttled = until      # grows back after the pause
+        logging.getLogger('RSSBot').warning(
+            f'Flood limit reached, sending is paused for {seconds}s and rate is {self.base_rate:.1f} msg/s')
+
+    def metrics(self):
+        return dict(self.stats, **{
+            'rate': self.rate(),
+            'max-rate': self.max_rate,
+            'throughput': self.throughput(),
+            'paused-for': self.pause()
+        })
+
+
+class DeliveryEngine:
+    '''Fan out a broadcast to many chats on a pool of workers.
+
+    Each chat is delivered by a single task, so messages of a chat keep their
+    order, while a shared bucket keeps the overall rate under telegram limits.
+    '''
+
+    def __init__(self, workers=32, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, group_rate=GROUP_RATE, burst=3):
+        self.workers = workers
+        self.global_bucket = TokenBucket(global_rate)
+        self.flood = FloodControl(global_rate)
+        self.resumed = 0        # end of the last pause that was waited for
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.logger = logging.getLogger('RSSBot')
+
+    @classmethod
+    def from_config(cls, config: dict):
+        config = config or dict()
+        return cls(
+            workers = config.get('workers', 32),
+            global_rate = config.get('global-rate', GLOBAL_RATE),
+            chat_rate = config.get('chat-rate', CHAT_RATE),
+            group_rate = config.get('group-rate', GROUP_RATE),
+            burst = config.get('chat-burst', 3))
+
+    def chat_bucket(self, chat_data):
+        if isinstance(chat_data, dict) and chat_data.get('type', Chat.PRIVATE) != Chat.PRIVATE:
+            return TokenBucket(self.group_rate, self.burst)
+        return TokenBucket(self.chat_rate, self.burst)
+
+    def throttle(self):
+        'Wait for a pause of flood control and the global rate'
+        while True:
+            pause = self.flood.pause()
+            while pause:
+                time.sleep(pause)
+                pause = self.flood.pause()
+            rate = self.flood.rate()
+            if self.flood.paused_until != self.resumed:
+                # start slowly after a pause instead of a burst of saved tokens
+                self.resumed = self.flood.paused_until
+                self.global_bucket.set_rate(rate, empty=True)
+            elif rate != self.global_bucket.rate:
+                self.global_bucket.set_rate(rate)
+            self.global_bucket.consume()
+            if not self.flood.pause():
+                return      # not paused while waiting for the bucket
+
+    def send(self, request, throttle=None):
+        '''Call `request()` after `throttle()` and retry it after the time that
+        telegram asks for on a RetryAfter error'''
+        throttle = throttle or self.throttle
+        for attempt in range(MAX_RETRIES + 1):
+            throttle()
+            try:
+                result = request()
+            except RetryAfter as e:
+                self.flood.retry_after(e.retry_after)
+                if attempt == MAX_RETRIES:
+                    raise
+                continue
+            self.flood.success()
+            return result
+
+    def broadcast(self, chats, deliver, job=None):
+        '''Call `deliver(chat_id, chat_data, send)` for each chat and return stats.
+
+        `deliver` must make each telegram request with `send(request)`, which
+        keeps the rates and retries on RetryAfter, and return number of sent
+        messages or None if the chat failed. Chats are consumed lazily and at
+        most twice the number of workers are queued at a time. Each chat is
+        marked as done in `job`, a Jobs.BroadcastJob, after it is delivered.
+        '''
+        stats = {'chats': 0, 'messages': 0, 'failed': 0}
+        stats_lock = Lock()
+        slots = BoundedSemaphore(self.workers * 2)
+
+        def task(chat_id, chat_data):
+            bucket = self.chat_bucket(chat_data)
+            def throttle():
+                bucket.consume()
+                self.throttle()
+            try:
+                # None is a failure that deliver handled, like a blocked chat
+                sent = deliver(chat_id, chat_data, lambda request: self.send(request, throttle))
+            except Exception:
+                self.logger.exception(f'Unhandled exception while delivering to {chat_id}')
+                sent = None
+            finally:
+                if job is not None:
+                    job.complete(chat_id)
+                slots.release()
+            with stats_lock:
+                stats['chats'] += 1
+                if sent is None:
+                    stats['failed'] += 1
+                else:
+                    stats['messages'] += sent
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(self.workers, 'delivery') as pool:
+            for chat_id, chat_data in chats:
+                slots.acquire()
+                pool.submit(task, chat_id, chat_data)
+
+        stats['elapsed'] = time.monotonic() - start
+        stats['rate'] = stats['messages'] / stats['elapsed'] if stats['elapsed'] else 0
+        self.log_stats(stats)
+        return stats
+
+    def log_stats(self, stats):
+        flood = self.flood.metrics()
+        self.logger.info(
+            'Delivered {messages} messages to {chats} chats in {elapsed:.1f}s ({rate:.1f} msg/s, {failed} failed)'.format_map(stats) +
+            ', target rate {rate:.1f} msg/s, {retry-after} flood waits, paused {paused:.1f}s'.format_map(flood))
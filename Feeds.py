@@ -0,0 +1,227 @@
+import hashlib
+import heapq
+import itertools
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Thread
+
+import bs4
+import soupsieve
+from bs4 import BeautifulSoup as Soup
+from lxml import etree
+
+CHUNK_SIZE = 16*1024
+
+
+def iter_elements(stream, tag):
+    '''Parse an xml stream incrementally and yield each `tag` element as a soup
+
+    Reading stops as soon as the consumer stops iterating, and parsed elements
+    are dropped, so memory does not grow with the size of the feed.'''
+    parser = etree.XMLPullParser(events=('end',), tag='{*}'+tag, resolve_entities=False, no_network=True)
+    try:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            parser.feed(chunk)
+            for _, element in parser.read_events():
+                yield Soup(etree.tostring(element), 'xml')
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+    finally:
+        stream.close()
+
+
+class FeedSource:
+    'Configuration of a single feed source and its compiled skip condition'
+
+    def __init__(self, configs: dict, breaker=None):
+        self.configs = configs
+        self.breaker = breaker          # Retry.CircuitBreaker of requests to the source
+        self.url = configs['source']
+        self.interval = configs.get('interval')         # None means use the bot interval
+        subscribers = configs.get('subscribers')        # None means all chats
+        self.subscribers = {str(s) for s in subscribers} if subscribers is not None else None
+        # streaming only works with xml feeds and a simple tag name as feeds-selector
+        self.streaming = False
+        if configs.get('streaming'):
+            if configs.get('feed-format', 'xml') == 'xml' and re.fullmatch(r'[\w-]+', configs['feeds-selector']):
+                self.streaming = True
+            else:
+                logging.getLogger('RSSBot').error(
+                    f'Can not stream {self.url}, "feeds-selector" must be a tag name of an xml feed')
+
+        # - skip-condition: how to check skip condition
+        #   - format: feed/{selector}, content/{selector}, title/{regex}, link/{regex}, none
+        self.skip_field = None
+        self.skip = lambda feed: False
+        skip_condition = configs.get('feed-skip-condition')
+        if isinstance(skip_condition, str):
+            self.skip_field, skip_condition = skip_condition.split('/', 1)
+            if self.skip_field in ('feed', 'content'):
+                selector = soupsieve.compile(skip_condition)
+                self.skip = lambda tag: selector.select_one(tag) is not None
+            elif self.skip_field in ('title', 'link'):
+                match = re.compile(skip_condition).match
+                self.skip = lambda text: bool(match(text))
+        self.plan = ExtractionPlan(configs, self.skip_field, self.skip)
+
+    def __getitem__(self, key):
+        return self.configs[key]
+
+    def get(self, key, default=None):
+        return self.configs.get(key, default)
+
+    def key(self, name):
+        'key of a per-source value in data_db'
+        return f'{name}:{self.url}'
+
+    def is_subscriber(self, chat_id):
+        return self.subscribers is None or str(chat_id) in self.subscribers
+
+    def __repr__(self):
+        return f'<FeedSource {self.url}>'
+
+
+def content_of(tag):
+    'Inner html of a tag, or the text if it is a string'
+    if isinstance(tag, bs4.NavigableString):
+        return tag.string
+    return ''.join([str(c) for c in tag.contents])
+
+
+def compile_selector(selector, html=False):
+    '''Return a function that finds the first match of `selector` in a tag
+
+    A tag name is matched while walking the descendants, which is much faster
+    than `select_one` or `find`, any other css selector is compiled once
+    with soupsieve.'''
+    if re.fullmatch(r'[\w-]+', selector):
+        name = selector.lower() if html else selector
+
+        def find(tag):
+            for element in tag.descendants:
+                if element.name == name:
+                    return element
+        return find
+    return soupsieve.compile(selector).select_one
+
+
+def fingerprint(feed):
+    'Identity of a feed that does not change when it is edited: its id, link or title'
+    identity = feed.get('id') or feed['link'] or feed['title']
+    if not identity:
+        identity = feed['content'].get_text() if feed['content'] is not None else ''
+    return hashlib.sha1(identity.strip().encode()).digest()
+
+
+class ExtractionPlan:
+    '''Selectors of a source compiled to a list of steps that run on each feed.
+
+    Each step extracts a field and the skip condition runs right after the
+    field it needs, so a skipped feed costs as little as possible.'''
+
+    def __init__(self, configs: dict, skip_field=None, skip=None):
+        html = configs.get('feed-format', 'xml') != 'xml'
+        self.skip_feed = skip if skip_field == 'feed' else None
+        self.steps = []     # (field, name in config, find, read, skip)
+        for field, name, required in (('title', 'title', False), ('link', 'link', False), ('date', 'time', True), ('id', 'id', False), ('content', 'content', False)):
+            selector = configs.get(f'{name}-selector')
+            if not selector:
+                # selectors could be None (null), except time-selector
+                if required:
+                    raise ValueError(f'"{name}-selector" of {configs["source"]} is not set')
+                continue
+            attribute = configs.get(f'{name}-attribute')
+            if field == 'content':
+                read = lambda tag: Soup(content_of(tag), features='lxml')
+            elif attribute:
+                read = lambda tag, attribute=attribute: str(tag.attrs[attribute])
+            else:
+                read = lambda tag: str(tag.text)
+            self.steps.append((field, name, compile_selector(selector, html), read, skip if skip_field == field else None))
+
+    def __call__(self, feed):
+        'Extract fields of a feed, returns None if the feed should be skipped'
+        if self.skip_feed and self.skip_feed(feed):
+            return None
+        result = {'title': None, 'link': None, 'content': None, 'date': None, 'id': None}
+        for field, name, find, read, skip in self.steps:
+            tag = find(feed)
+            if tag is None:
+                raise ValueError(f'"{name}-selector" did not match anything in the feed')
+            value = result[field] = read(tag)
+            if skip and skip(value):
+                return None
+        return result
+
+
+class FeedScheduler:
+    '''Check many feed sources on a bounded pool of workers.
+
+    Each source is rescheduled after its check is done, so a slow source
+    never runs twice at the same time.
+    '''
+
+    def __init__(self, check, interval, workers=4):
+        self.check = check              # check(source)
+        self.interval = interval        # interval(source) -> seconds
+        self.queue = []
+        self.counter = itertools.count()
+        self.cond = Condition()
+        self.running = False
+        self.pool = ThreadPoolExecutor(workers, 'feeds')
+        self.thread = Thread(target=self.__run, name='feed-scheduler', daemon=True)
+        self.logger = logging.getLogger('RSSBot')
+
+    def schedule(self, source, delay=0):
+        with self.cond:
+            heapq.heappush(self.queue, (time.monotonic() + delay, next(self.counter), source))
+            self.cond.notify()
+
+    def reschedule(self):
+        'Recompute due time of all waiting sources, e.g. after changing the interval'
+        with self.cond:
+            now = time.monotonic()
+            self.queue = [(now + self.interval(s), next(self.counter), s) for _, _, s in self.queue]
+            heapq.heapify(self.queue)
+            self.cond.notify()
+
+    def start(self, sources):
+        self.running = True
+        for source in sources:
+            self.schedule(source)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.pool.shutdown(wait=True)
+
+    def __run(self):
+        while True:
+            with self.cond:
+                while self.running and (not self.queue or self.queue[0][0] > time.monotonic()):
+                    self.cond.wait(self.queue[0][0] - time.monotonic() if self.queue else None)
+                if not self.running:
+                    return
+                _, _, source = heapq.heappop(self.queue)
+            self.pool.submit(self.__check, source)
+
+    def __check(self, source):
+        try:
+            self.check(source)
+        except Exception:
+            self.logger.exception(f'Unhandled exception while checking {source}')
+        finally:
+            if self.running:
+                delay = self.interval(source)
+                self.logger.info(f'Checking {source.url} for new feeds in {delay} seconds')
+                self.schedule(source, delay)
@@ -1,11 +1,10 @@
 import html
 import json
 import logging
-import pickle
 import random
 import string
-from threading import Timer
 import BugReporter
+import Chats
 from datetime import datetime, timedelta
 
 from dateutil.parser import parse
@@ -144,17 +143,17 @@ def add_admin_handlers(server: BotHandler):
     @dispatcher_decorators.commandHandler
     @admin_auth
     def state(u: Update, c: CallbackContext):
-        members, chats = 0, 0
-        msg = u.message.reply_text('⏳ Please wait, counting members...')
-        with server.env.begin(server.chats_db) as txn:
-            chats = int(txn.stat()["entries"])
-            for key, value in txn.cursor():
-                v = pickle.loads(value)
-                members += v['members-count']
-        msg.edit_text(
-            f'👥chats:\t{chats}\n' +
-            f'👤members:\t{members}\n' +
-            f'🤵admins:\t{len(server.adminID)}'
+        stats = server.chat_stats()
+        flood = server.delivery.flood.metrics()
+        ceiling = f'{flood["ceiling"]:.1f} msg/s' if flood['ceiling'] is not None else '-'
+        u.message.reply_text(
+            f'👥chats:\t{stats["chats"]}\n' +
+            f'👤members:\t{stats["members"]}\n' +
+            f'🤵admins:\t{len(server.adminID)}\n' +
+            ''.join(f'\n{chat_type}:\t{count}' for chat_type, count in stats['types'].items()) +
+            f'\n\n📤sent:\t{flood["sent"]}\n' +
+            f'⚡️rate:\t{flood["rate"]:.1f}/{flood["max-rate"]} msg/s (now {flood["throughput"]:.1f})\n' +
+            f'🚧flood waits:\t{flood["retry-after"]} ({flood["paused"]:.0f}s paused, ceiling {ceiling})'
         )
 
     @dispatcher_decorators.commandHandler
@@ -164,10 +163,11 @@ def add_admin_handlers(server: BotHandler):
         with server.env.begin(server.chats_db) as txn:
             res = 'total: '+str(txn.stat()["entries"])+'\n'
             for key, value in txn.cursor():
-                chat = pickle.loads(value)
-                if type(chat) is not type(dict()):
+                try:
+                    chat = Chats.decode(value)
+                except Exception as e:
                     res += html.escape(
-                        f'\n bad data type; type:{type(chat)}, value:{chat}\n')
+                        f'\n bad chat record; id:{key.decode()}, error:{e}\n')
                     continue
                 if 'username' in chat:
                     chat['username'] = '@'+chat['username']
@@ -178,12 +178,14 @@ def add_admin_handlers(server: BotHandler):
     @dispatcher_decorators.commandHandler
     @admin_auth
     def send_feed_toall(u: Update, c: CallbackContext):
-        server.send_feed(
-            server.render_feed(
-                next(server.read_feed()),
-                server.get_string('last-feed')
-            ),
-            server.iter_all_chats())
+        for source in server.feeds:
+            feed = next(server.read_feed(source = source), None)
+            if feed is None:
+                continue
+            messages = server.render_feed(feed, server.get_string('last-feed'), source)
+            if messages is None:
+                continue
+            server.broadcast('feed', messages, source)
 
     @dispatcher_decorators.commandHandler
     @admin_auth
@@ -193,11 +195,7 @@ def add_admin_handlers(server: BotHandler):
                 server.interval = int(c.args[0])
                 u.message.reply_text(
                     '✅ Interval changed to '+str(server.interval))
-                server.check_thread.cancel()
-                if server.check_thread.is_alive():
-                    server.check_thread.join()
-                server.check_thread = Timer(server.interval, server.check_new_feed)
-                server.check_thread.start()
+                server.reschedule()
                 server.logger.info('Interval changed to '+str(server.interval))
                 server.set_data(
                     'interval', server.interval, DB = server.data_db)
@@ -635,41 +633,74 @@ def add_admin_handlers(server: BotHandler):
             u.effective_chat.id, 'OK, now you can send message to add', reply_markup=add_keyboard(c))
         return STATE_ADD
 
-    def send_message(chat_id, c: CallbackContext):
+    def send_message(chat_id, messages, user_data = None):
         chat = server.bot.get_chat(chat_id)
-        for msg in c.user_data['messages']:
+        for msg in messages:
             # send message to admin for a debug!
             if msg['type'] == 'text':
                 try:
-                    chat.send_message(
+                    server.delivery.send(lambda: chat.send_message(
                         msg['text'],
                         parse_mode=msg['parser']
-                    ).message_id
+                    ))
                 except BadRequest as ex:
                     chat.send_message(
                         msg['text']+'\n\n⚠️ CAN NOT PARSE.\n'+ex.message,
                         reply_markup=text_markup
                     )
-                    c.user_data['had-error'] = True
+                    if user_data is not None:
+                        user_data['had-error'] = True
                     msg['had-error'] = True
                     return STATE_ADD
             elif msg['type'] == 'photo':
                 try:
-                    chat.send_photo(
+                    server.delivery.send(lambda: chat.send_photo(
                         msg['photo'],
                         msg['caption'],
                         parse_mode=msg['parser']
-                    ).message_id
+                    ))
                 except BadRequest as ex:
                     chat.send_photo(
                         msg['photo'],
                         caption=msg['caption'] +
                         '\n\n⚠️ CAN NOT PARSE.\n'+ex.message
                     ).message_id
-                    c.user_data['had-error'] = True
+                    if user_data is not None:
+                        user_data['had-error'] = True
                     msg['had-error'] = True
                     return STATE_ADD
 
+    def stored_message(msg):
+        'A copy of a message that can be stored in a broadcast job'
+        msg = {k: v for k, v in msg.items() if k != 'had-error'}
+        if msg['parser'] is DEFAULT_NONE:
+            msg['parser'] = None
+        if msg['type'] == 'photo':
+            msg['photo'] = msg['photo'].file_id
+        return msg
+
+    def send_to_all(payload, chats, job):
+        'Runner of sendall broadcast jobs'
+        remove_ids = []
+        for chat_id, chat_data in chats:
+            if chat_id != payload['from']:
+                try:
+                    send_message(chat_id, payload['messages'])
+                except Unauthorized as e:
+                    server.log_bug(e, 'handled an exception while trying to send message to a chat. removing chat',
+                                   report=False, chat_id=chat_id, chat_data=chat_data)
+                    remove_ids.append(chat_id)
+                except Exception as e:
+                    server.log_bug(
+                        e, 'exception while trying to send message to a chat', chat_id=chat_id, chat_data=chat_data)
+            job.complete(chat_id)
+
+        for chat_id in remove_ids:
+            server.delete_chat(chat_id, batch=True)
+        server.writes.flush()
+
+    server.jobs.register('sendall', send_to_all)
+
     @sendall_conv_handler.state(STATE_CONFIRM)
     @HandlerDecorator(CallbackQueryHandler, pattern='^yes$')
     def send(u: Update, c: CallbackContext):
@@ -689,7 +720,7 @@ def add_admin_handlers(server: BotHandler):
         c.user_data['last-message'] = server.bot.send_message(u.effective_chat.id,
                                                               '✅ Done\nSending message to all users, groups and channels')
 
-        res = send_message(u.effective_chat.id, c)
+        res = send_message(u.effective_chat.id, c.user_data['messages'], c.user_data)
         if res:
             u.effective_chat.send_message(
                 '🛑 there is a problem with your messages, please fix them.',
@@ -698,28 +729,8 @@ def add_admin_handlers(server: BotHandler):
             )
             return res
 
-        remove_ids = []
-        for chat_id, chat_data in server.iter_all_chats():
-            if chat_id != u.effective_chat.id:
-                try:
-                    send_message(chat_id, c)
-                except Unauthorized as e:
-                    server.log_bug(e, 'handled an exception while trying to send message to a chat. removing chat',
-                                   report=False, chat_id=chat_id, chat_data=chat_data)
-                    try:
-                        with server.env.begin(server.chats_db, write=True) as txn:
-                            txn.delete(str(chat_id).encode())
-                    except Exception as e2:
-                        server.log_bug(
-                            e2, 'exception while trying to remove chat')
-                        remove_ids.append(chat_id)
-                except Exception as e:
-                    server.log_bug(
-                        e, 'exception while trying to send message to a chat', chat_id=chat_id, chat_data=chat_data)
-
-        for chat_id in remove_ids:
-            with server.env.begin(server.chats_db, write=True) as txn:
-                txn.delete(str(chat_id).encode())
+        messages = [stored_message(msg) for msg in c.user_data['messages']]
+        server.broadcast('sendall', {'from': str(u.effective_chat.id), 'messages': messages})
 
         cleanup_last_preview(u.effective_chat.id, c)
         for key in ('messages', 'prev-dict', 'had-error', 'edit-cap', 'editing-prev-id'):
@@ -788,7 +799,7 @@ def add_users_handlers(server: BotHandler):
             u.message.reply_markdown_v2(
                 server.get_string('group-intro'))
 
-        server.set_data(key=str(chat.id), value=data)
+        server.set_chat(chat.id, data)
 
     @dispatcher_decorators.commandHandler
     def last_feed(u: Update, c: CallbackContext):
@@ -797,12 +808,15 @@ def add_users_handlers(server: BotHandler):
                 u.message.reply_text(server.get_string('time-limit-error'))
                 return
         wait_msg = u.message.reply_animation(open("wait animation.tgs", 'rb'))
-        server.send_feed(
-            server.render_feed(
-                next(server.read_feed(0)),
-                server.get_string('last-feed')
-            ),
-            chats = [(u.effective_chat.id, c.chat_data)])
+        for source in server.feeds:
+            if source.is_subscriber(u.effective_chat.id):
+                feed = server.last_feed(source)
+                if feed is None:
+                    continue
+                messages = server.render_feed(feed, server.get_string('last-feed'), source)
+                if messages is None:
+                    continue
+                server.send_feed(messages, chats = [(u.effective_chat.id, c.chat_data)])
         wait_msg.delete()
         c.user_data['time'] = datetime.now() + timedelta(minutes = 2)      #The next request is available 2 minutes later
     
@@ -831,8 +845,7 @@ def add_other_handlers(server: BotHandler):
             status = u.my_chat_member.new_chat_member.status
             if status in (ChatMember.KICKED, ChatMember.LEFT, ChatMember.RESTRICTED):
                 logging.info('Bot had been kicked or blocked by a user')
-                with server.env.begin(server.chats_db, write = True) as txn:
-                    txn.delete(str(u.my_chat_member.chat.id).encode())
+                server.delete_chat(u.my_chat_member.chat.id)
 
     @dispatcher_decorators.messageHandler(Filters.status_update.new_chat_members)
     def onjoin(u: Update, c: CallbackContext):
@@ -840,7 +853,7 @@ def add_other_handlers(server: BotHandler):
             if member.username == server.bot.username:
                 data = u.effective_chat.to_dict()
                 data['members-count'] = u.effective_chat.get_members_count()-1
-                server.set_data(key = str(u.effective_chat.id), value = data)
+                server.set_chat(u.effective_chat.id, data)
                 server.bot.send_message(
                     server.ownerID,
                     '<i>Joined to a chat:</i>\n' +
@@ -855,7 +868,7 @@ def add_other_handlers(server: BotHandler):
     @dispatcher_decorators.messageHandler(Filters.status_update.left_chat_member)
     def onkick(u: Update, c: CallbackContext):
         if u.message.left_chat_member['username'] == server.bot.username:
-            data = server.get_data(str(u.effective_chat.id))
+            data = server.get_chat(u.effective_chat.id)
             if data:
                 server.bot.send_message(
                     server.ownerID,
@@ -864,8 +877,7 @@ def add_other_handlers(server: BotHandler):
                             data, indent = 2, ensure_ascii = False)),
                     ParseMode.HTML,
                     disable_notification = True)
-                with server.env.begin(server.chats_db, write = True) as txn:
-                    txn.delete(str(u.effective_chat.id).encode())
+                server.delete_chat(u.effective_chat.id)
 
     @dispatcher_decorators.errorHandler
     def error_handler(update: object, context: CallbackContext) -> None:
@@ -0,0 +1,225 @@
+'''A pooled keep-alive HTTP client for feeds and images
+
+Connections are kept in a pool for each host and reused by later requests,
+so checking many feeds of the same host does not open a new TCP and TLS
+connection for each of them. Responses are decoded while they are read and
+stop with an error when they grow larger than `max_size`.
+'''
+import importlib
+import logging
+import zlib
+
+import certifi
+from telegram.utils.request import urllib3     # vendored urllib3 or the installed one
+
+try:
+    import brotli
+    if not hasattr(brotli.Decompressor, 'can_accept_more_data'):
+        brotli = None       # before 1.2 it can not limit its output
+except ModuleNotFoundError:
+    brotli = None
+
+CHUNK_SIZE = 64*1024
+
+
+class HttpError(Exception):
+    'A request failed, `status` is the http status of the response if there is one'
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class ResponseTooLarge(HttpError):
+    'A response is larger than the maximum size of the client'
+
+
+def _decoder(encoding):
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        return _ZlibDecoder()
+    if encoding == 'br' and brotli:
+        return _BrotliDecoder()
+    if encoding in ('', 'identity'):
+        return None
+    raise HttpError(f'Unsupported content encoding: {encoding}')
+
+
+class _ZlibDecoder:
+    '''Decoders return at most about `max_length` bytes from `decompress`,
+    while `more` is true the rest is returned by calling it with no data'''
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)    # zlib or gzip header
+
+    @property
+    def more(self):
+        return bool(self.decompressor.unconsumed_tail)
+
+    def decompress(self, data, max_length=0):
+        return self.decompressor.decompress(data or self.decompressor.unconsumed_tail, max_length)
+
+    def flush(self):
+        return self.decompressor.flush()
+
+
+class _BrotliDecoder:
+
+    def __init__(self):
+        self.decompressor = brotli.Decompressor()
+
+    @property
+    def more(self):
+        return not self.decompressor.can_accept_more_data()
+
+    def decompress(self, data, max_length=0):
+        if max_length:
+            return self.decompressor.process(data, output_buffer_limit=max_length)
+        return self.decompressor.process(data)
+
+    def flush(self):
+        return b''
+
+
+class HttpResponse:
+    '''A response that is read as a file, decoded and counted against the
+    maximum size. Close it, or use it in a `with` statement, to return its
+    connection to the pool.'''
+
+    def __init__(self, response, url, max_size=None):
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.headers
+        self.max_size = max_size
+        self.buffer = bytearray()
+        self.size = 0
+        self.done = False
+        try:
+            self.decoder = _decoder(self.headers.get('Content-Encoding', '').strip().lower())
+        except HttpError:
+            self.decoder = None
+            self.close()
+            raise
+        length = self.headers.get('Content-Length')
+        if max_size and self.decoder is None and length and length.isdigit() and int(length) > max_size:
+            self.close()
+            raise ResponseTooLarge(f'{url} is {length} bytes, more than {max_size}', self.status)
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            self.__fill(CHUNK_SIZE if size < 0 else max(size - len(self.buffer), 1))
+        if size < 0 or size >= len(self.buffer):
+            data, self.buffer = bytes(self.buffer), bytearray()
+        else:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        return data
+
+    def __fill(self, size):
+        limit = self.max_size - self.size + 1 if self.max_size else 0
+        # decompressed data is limited too, so a small compressed response
+        # can not fill the memory
+        if self.decoder and self.decoder.more:
+            raw = b''
+        else:
+            try:
+                raw = self.response.read(size, decode_content=False)
+            except urllib3.exceptions.HTTPError as e:
+                raise HttpError(f'Can not read {self.url}: {e}') from e
+            self.done = not raw
+        try:
+            if not self.decoder:
+                data = raw
+            elif self.done:
+                data = self.decoder.flush()
+            else:
+                data = self.decoder.decompress(raw, limit)
+        except Exception as e:
+            raise HttpError(f'Can not decode {self.url}: {e}') from e
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            self.close()
+            raise ResponseTooLarge(f'{self.url} is larger than {self.max_size} bytes', self.status)
+        self.buffer += data
+
+    def close(self):
+        if self.done or self.response.length_remaining == 0:
+            self.response.read(decode_content=False)    # ends a response without a body, like 304
+        else:
+            # unread data is left on the connection, it can not be reused
+            self.response.close()
+        self.response.release_conn()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class HttpClient:
+    '''Send GET requests on a pool of keep-alive connections for each host.
+
+    `proxy` is the `proxy-info` of the bot, an http or socks proxy url in
+    `proxy_url` and more arguments of the proxy in `urllib3_proxy_kwargs`.
+    '''
+
+    def __init__(self, proxy=None, connections=10, hosts=100, max_size=20*1024*1024, connect_timeout=10):
+        self.max_size = max_size
+        self.connect_timeout = connect_timeout
+        self.encodings = 'gzip, deflate, br' if brotli else 'gzip, deflate'
+        kwargs = dict(
+            num_pools = hosts,
+            maxsize = connections,
+            cert_reqs = 'CERT_REQUIRED',
+            ca_certs = certifi.where())
+        proxy = proxy or dict()
+        proxy_url = proxy.get('proxy_url')
+        if not proxy_url:
+            self.pool = urllib3.PoolManager(**kwargs)
+        elif proxy_url.startswith('socks'):
+            try:
+                SOCKSProxyManager = importlib.import_module(urllib3.__name__ + '.contrib.socks').SOCKSProxyManager
+            except ImportError as e:
+                raise RuntimeError('PySocks is missing') from e
+            self.pool = SOCKSProxyManager(proxy_url, **kwargs, **proxy.get('urllib3_proxy_kwargs', dict()))
+        else:
+            self.pool = urllib3.proxy_from_url(proxy_url, **kwargs, **proxy.get('urllib3_proxy_kwargs', dict()))
+            if self.pool.proxy.auth:
+                self.pool.proxy_headers.update(urllib3.make_headers(proxy_basic_auth=self.pool.proxy.auth))
+        self.logger = logging.getLogger('RSSBot')
+
+    @classmethod
+    def from_config(cls, config: dict = None, proxy=None):
+        config = config or dict()
+        return cls(
+            proxy = proxy,
+            connections = config.get('connections', 10),
+            hosts = config.get('hosts', 100),
+            max_size = config.get('max-size', 20*1024*1024),
+            connect_timeout = config.get('connect-timeout', 10))
+
+    def get(self, url, headers=None, timeout=30, max_size=None):
+        '''Send a GET request and return an HttpResponse if its status is 2xx
+        or 304, raises HttpError otherwise. Redirects are followed.
+
+        `max_size` is the maximum size of the response, the maximum size of
+        the client if it is None and no limit if it is 0.'''
+        headers = dict(headers or dict())
+        headers.setdefault('Accept-Encoding', self.encodings)
+        try:
+            response = self.pool.request(
+                'GET', url,
+                headers = headers,
+                preload_content = False,
+                decode_content = False,
+                # failed requests are retried by the caller, not here
+                retries = urllib3.Retry(total=None, connect=0, read=0, redirect=5),
+                timeout = urllib3.Timeout(connect=min(self.connect_timeout, timeout), read=timeout))
+        except urllib3.exceptions.HTTPError as e:
+            raise HttpError(f'Can not get {url}: {e}') from e
+        if 200 <= response.status <= 299 or response.status == 304:
+            return HttpResponse(response, url, self.max_size if max_size is None else max_size)
+        response.close()
+        response.release_conn()
+        raise HttpError(f'Can not get {url}: HTTP {response.status} {response.reason}', response.status)
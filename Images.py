@@ -0,0 +1,142 @@
+'''Check images of a feed before they are sent as photos
+
+Telegram fetches a photo from its url for every chat until one upload gives
+a file_id, so a broken or too large image fails once per chat. Images are
+probed once with a ranged GET, their size and dimensions are read from the
+headers and the first bytes of the file, and results are cached by url.
+'''
+import logging
+import re
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import Cache
+
+# limits of sending a photo by url (https://core.telegram.org/bots/api#sendphoto)
+MAX_BYTES = 5*1024*1024
+MAX_DIMENSIONS = 10000      # width + height
+MAX_RATIO = 20
+CONTENT_RANGE = re.compile(r'bytes \d+-\d+/(\d+)')
+
+
+def _jpeg_size(data):
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xff:
+            return None
+        marker = data[i+1]
+        if marker == 0xff:
+            i += 1      # padding
+            continue
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            height, width = struct.unpack('>HH', data[i+5:i+9])
+            return width, height
+        i += 2 + struct.unpack('>H', data[i+2:i+4])[0]
+    return None
+
+
+def sniff(data):
+    'Return (format, width, height) of an image from its first bytes, or None'
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return ('png',) + struct.unpack('>II', data[16:24])
+    if data[:6] in (b'GIF87a', b'GIF89a') and len(data) >= 10:
+        return ('gif',) + struct.unpack('<HH', data[6:10])
+    if data[:2] == b'\xff\xd8':
+        size = _jpeg_size(data)
+        return ('jpeg',) + size if size else None
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP' and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b'VP8 ':
+            width, height = struct.unpack('<HH', data[26:30])
+            return 'webp', width & 0x3fff, height & 0x3fff
+        if chunk == b'VP8L':
+            bits = int.from_bytes(data[21:25], 'little')
+            return 'webp', (bits & 0x3fff) + 1, (bits >> 14 & 0x3fff) + 1
+        if chunk == b'VP8X':
+            return 'webp', int.from_bytes(data[24:27], 'little') + 1, int.from_bytes(data[27:30], 'little') + 1
+    if data[:2] == b'BM' and len(data) >= 26:
+        width, height = struct.unpack('<ii', data[18:26])
+        return 'bmp', width, abs(height)
+    return None
+
+
+class ImageProber:
+    '''Probe images on a pool of workers and cache the results for `ttl`
+    seconds.
+
+    A result is a dict with the `status` of the image, `ok`, `bad` or `tiny`
+    (tracking pixels and spacers, smaller than `min_size` pixels), the
+    `reason` if it is not ok and `size`, `format`, `width` and `height` if
+    they are known.
+    '''
+
+    def __init__(self, http, workers=8, ttl=3600, timeout=10, min_size=2, cache_size=1024, read=32*1024):
+        self.http = http
+        self.ttl = ttl
+        self.timeout = timeout
+        self.min_size = min_size
+        self.read = read
+        self.pool = ThreadPoolExecutor(workers, 'images')
+        self.cache = Cache.LRUCache(cache_size)
+        self.logger = logging.getLogger('RSSBot')
+
+    @classmethod
+    def from_config(cls, http, config: dict = None):
+        config = config or dict()
+        return cls(
+            http,
+            workers = config.get('workers', 8),
+            ttl = config.get('ttl', 3600),
+            timeout = config.get('timeout', 10),
+            min_size = config.get('min-size', 2))
+
+    def probe_all(self, urls):
+        'Probe urls at the same time, returns a dict of url => result'
+        urls = set(urls)
+        results = dict()
+        for url in urls:
+            cached = self.cache.get(url)
+            if cached and cached[0] > time.monotonic():
+                results[url] = cached[1]
+        futures = {url: self.pool.submit(self.probe, url) for url in urls if url not in results}
+        for url, future in futures.items():
+            results[url] = future.result()
+            self.cache.put(url, (time.monotonic() + self.ttl, results[url]))
+        return results
+
+    def probe(self, url):
+        try:
+            with self.http.get(url, {'Range': f'bytes=0-{self.read - 1}'}, self.timeout, max_size=0) as response:
+                content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+                size = None
+                if response.status == 206:
+                    match = CONTENT_RANGE.match(response.headers.get('Content-Range', ''))
+                    size = int(match.group(1)) if match else None
+                elif response.headers.get('Content-Length'):
+                    size = int(response.headers['Content-Length'])
+                data = response.read(self.read)
+        except Exception as e:
+            self.logger.info(f'Can not probe image {url}: {e}')
+            return {'status': 'bad', 'reason': f'unreachable: {e}'}
+        result = {'status': 'ok', 'size': size}
+        sniffed = sniff(data)
+        if sniffed:
+            result['format'], result['width'], result['height'] = sniffed
+        elif not content_type.startswith('image/'):
+            return dict(result, status='bad', reason=f'not an image: {content_type}')
+        return self.check(result)
+
+    def check(self, result):
+        if result['size'] and result['size'] > MAX_BYTES:
+            return dict(result, status='bad', reason=f'too large: {result["size"]} bytes')
+        width, height = result.get('width'), result.get('height')
+        if width is None:
+            return result
+        if min(width, height) < max(1, self.min_size):
+            return dict(result, status='tiny', reason=f'too small: {width}x{height}')
+        if width + height > MAX_DIMENSIONS:
+            return dict(result, status='bad', reason=f'too large: {width}x{height}')
+        if max(width, height) / min(width, height) > MAX_RATIO:
+            return dict(result, status='bad', reason=f'bad ratio: {width}x{height}')
+        return result
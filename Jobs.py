@@ -0,0 +1,170 @@
+import logging
+import pickle
+import time
+from collections import deque
+from threading import Lock
+
+import Chats
+
+# a job whose runner raised this many times is removed instead of resumed
+MAX_ATTEMPTS = 3
+
+
+class BroadcastJob:
+    '''Progress of a broadcast to all chats.
+
+    Chats are visited in the order of their keys. `cursor` is the last chat
+    that it and all chats before it are done, `done` has the chats after
+    `cursor` that are done while a chat before them is still being sent to.
+    Progress is saved every `checkpoint` chats, so a restarted job sends to
+    at most that many chats again.
+
+    A job that is split between sender processes (check Shards) has the same
+    progress for each shard in `progress`, its chats are done if they are
+    done in the job or in their shard.
+    '''
+
+    def __init__(self, queue, id, kind, payload, source=None, cursor=None, done=(), chats=0, shards=None, progress=None, attempts=0):
+        self.queue = queue
+        self.id = id
+        self.kind = kind
+        self.payload = payload
+        self.source = source
+        self.cursor = cursor
+        self.done = set(done)
+        self.chats = chats          # chats that are done
+        self.shards = shards        # number of shards, None if it is sent by a single process
+        self.progress = {shard: (cursor, set(done)) for shard, (cursor, done) in (progress or dict()).items()}
+        self.attempts = attempts    # runs that raised an exception
+        self.started = deque()      # chats after cursor in the order they were started
+        self.lock = Lock()
+
+    def pending(self, chats):
+        'Skip chats that are done, `chats` must be in key order'
+        for chat_id, chat_data in chats:
+            if self.is_done(chat_id):
+                continue
+            with self.lock:
+                self.started.append(chat_id)
+            yield chat_id, chat_data
+
+    def is_done(self, chat_id):
+        if self.cursor is not None and chat_id <= self.cursor or chat_id in self.done:
+            return True
+        if self.shards:
+            cursor, done = self.progress.get(Chats.shard_of(chat_id, self.shards), (None, ()))
+            return cursor is not None and chat_id <= cursor or chat_id in done
+        return False
+
+    def complete(self, chat_id):
+        'Mark a chat as done, sent or failed'
+        with self.lock:
+            self.done.add(chat_id)
+            self.chats += 1
+            while self.started and self.started[0] in self.done:
+                self.cursor = self.started.popleft()
+                self.done.discard(self.cursor)
+            if self.chats % self.queue.checkpoint == 0:
+                self.queue.save(self)
+
+    def complete_shard(self, shard, cursor, done, chats):
+        'Save progress of a shard, `chats` were done since its last progress'
+        with self.lock:
+            self.progress[shard] = (cursor, set(done))
+            self.chats += chats
+            self.queue.save(self)
+
+    def record(self):
+        return {
+            'kind': self.kind,
+            'payload': self.payload,
+            'source': self.source,
+            'cursor': self.cursor,
+            'done': list(self.done),
+            'chats': self.chats,
+            'shards': self.shards,
+            'progress': {shard: (cursor, list(done)) for shard, (cursor, done) in self.progress.items()},
+            'attempts': self.attempts
+        }
+
+    def __repr__(self):
+        return f'<BroadcastJob {self.id} {self.kind} chats={self.chats}>'
+
+
+class JobQueue:
+    '''Broadcast jobs that are kept in lmdb until they are finished.
+
+    Each kind of job has a runner, `runner(payload, chats, job)` must send
+    the payload to `chats` and call `job.complete` for each of them, or
+    `job.complete_shard` if chats are sent by several processes.
+    '''
+
+    def __init__(self, env, db, checkpoint=100):
+        self.env = env
+        self.db = db
+        self.checkpoint = max(1, checkpoint)
+        self.runners = dict()
+        self.save_lock = Lock()
+        self.logger = logging.getLogger('RSSBot')
+
+    def register(self, kind, runner):
+        self.runners[kind] = runner
+
+    def create(self, kind, payload, source=None, txn=None):
+        'Add a new job, it is written in `txn` if it is given'
+        job = BroadcastJob(self, f'{time.time_ns():020d}', kind, payload, source)
+        if txn is not None:
+            txn.put(job.id.encode(), pickle.dumps(job.record()), db = self.db)
+        else:
+            self.save(job)
+        return job
+
+    def save(self, job):
+        with self.save_lock:
+            with self.env.begin(self.db, write=True) as txn:
+                txn.put(job.id.encode(), pickle.dumps(job.record()))
+
+    def finish(self, job):
+        with self.save_lock:
+            with self.env.begin(self.db, write=True) as txn:
+                txn.delete(job.id.encode())
+        self.logger.info(f'Broadcast job {job.id} finished, {job.chats} chats')
+
+    def unfinished(self):
+        'Jobs that were not finished before the last stop, oldest first'
+        jobs = []
+        with self.env.begin(self.db) as txn:
+            for key, value in txn.cursor():
+                try:
+                    record = pickle.loads(value)
+                except Exception:
+                    self.logger.exception(f'Bad broadcast job {key.decode()}')
+                    continue
+                jobs.append(BroadcastJob(self, key.decode(), **record))
+        return jobs
+
+    def run(self, job, chats):
+        '''Run a job on `chats` (in key order, starting after `job.cursor`) and
+        remove it when it is done. A runner returns False if the job is not
+        done, it is kept and resumed on the next start. A job whose runner
+        raises is kept too, until it raised MAX_ATTEMPTS times.'''
+        runner = self.runners.get(job.kind)
+        if runner is None:
+            self.logger.error(f'No runner for broadcast job {job.id} of kind {job.kind}')
+            return
+        try:
+            done = runner(job.payload, job.pending(chats), job)
+        except Exception:
+            job.attempts += 1
+            if job.attempts >= MAX_ATTEMPTS:
+                self.logger.exception(f'Broadcast job {job.id} failed {job.attempts} times, it is removed')
+                self.finish(job)
+            else:
+                self.logger.exception(f'Broadcast job {job.id} failed, it resumes on the next start')
+                self.save(job)
+            return
+        if done is False:
+            self.save(job)
+            self.logger.warning(f'Broadcast job {job.id} is not done, it resumes on the next start')
+            return
+        self.finish(job)
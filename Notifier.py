@@ -0,0 +1,96 @@
+import html
+import logging
+import time
+from collections import OrderedDict, deque
+from threading import Condition, Thread
+
+
+class OwnerNotifier:
+    '''Send exception reports to the owner from a background thread.
+
+    The first event of a tag is reported in full, unless `max_reports` were
+    already sent in the current `window`. Other events are counted and sent
+    as a single digest at the end of the window. A tag is reported in full
+    again only after a window without it, so an outage sends at most
+    `max_reports` + 1 messages per window.
+
+    `send(text, filename, disable_notification)` sends a message, it is only
+    called from the notifier thread.
+    '''
+
+    def __init__(self, send, window=60, max_reports=5):
+        self.send = send
+        self.window = window
+        self.max_reports = max_reports
+        self.outbox = deque()
+        self.counts = OrderedDict()     # tag => [count, summary, disable notification]
+        self.active = set()             # tags of this window
+        self.known = set()              # tags of the last window
+        self.reports = 0
+        self.window_end = time.monotonic() + window
+        self.condition = Condition()
+        self.stopped = False
+        self.logger = logging.getLogger('RSSBot')
+        self.thread = Thread(target=self.__run, name='owner-notifier', daemon=True)
+        self.thread.start()
+
+    def notify(self, tag, summary, build, disable_notification=False):
+        '''Report an event, `build()` returns (text, filename) of a full
+        report and is only called if one is sent. Never blocks on telegram.'''
+        with self.condition:
+            full = tag not in self.active and tag not in self.known and self.reports < self.max_reports
+            self.active.add(tag)
+            if not full:
+                count = self.counts.setdefault(tag, [0, summary, True])
+                count[0] += 1
+                count[2] = count[2] and disable_notification
+                return
+            self.reports += 1
+        text, filename = build()
+        with self.condition:
+            self.outbox.append((text, filename, disable_notification))
+            self.condition.notify()
+
+    def digest(self, counts):
+        lines = [f'<b>{sum(c[0] for c in counts.values())} more exceptions in the last {self.window}s</b>']
+        for tag, (count, summary, _) in counts.items():
+            line = f'<i>{html.escape(tag)}</i>: {count} times'
+            if summary:
+                line += f'\n{html.escape(summary)}'
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def __next_window(self):
+        counts, self.counts = self.counts, OrderedDict()
+        self.known, self.active = self.active, set()
+        self.reports = 0
+        self.window_end = time.monotonic() + self.window
+        if counts:
+            silent = all(c[2] for c in counts.values())
+            self.outbox.append((self.digest(counts), 'exceptions.html', silent))
+
+    def __run(self):
+        while True:
+            with self.condition:
+                while not self.outbox and not self.stopped:
+                    timeout = self.window_end - time.monotonic()
+                    if timeout <= 0:
+                        self.__next_window()
+                        continue
+                    self.condition.wait(timeout)
+                if not self.outbox and self.stopped:
+                    return
+                text, filename, disable_notification = self.outbox.popleft()
+            try:
+                self.send(text, filename, disable_notification)
+            except Exception:
+                # not log_bug, that would report this failure again
+                self.logger.exception('Exception while sending a report to owner')
+
+    def stop(self):
+        'Send waiting reports and the digest of the current window'
+        with self.condition:
+            self.__next_window()
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
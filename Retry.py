@@ -0,0 +1,103 @@
+import random
+import time
+from threading import Lock
+
+
+class CircuitOpen(Exception):
+    'A source failed too many times and is not requested until its cooldown ends'
+
+
+class RetryPolicy:
+    '''Delays between retries of failed feed requests.
+
+    The delay after the n-th failure is `delay * backoff**(n-1)`, at most
+    `max_delay`, and a random part of it (`jitter`) is removed so sources
+    that failed together do not retry together. Retries stop `max_time`
+    seconds after the first failure. After `failures` failures in a row the
+    circuit of the source opens for `cooldown` seconds.
+    '''
+
+    def __init__(self, delay=3, backoff=2, max_delay=300, max_time=1500, jitter=0.5,
+            failures=5, cooldown=900, timeout=30):
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.max_time = max_time
+        self.jitter = jitter
+        self.failures = failures
+        self.cooldown = cooldown
+        self.timeout = timeout
+
+    @classmethod
+    def from_config(cls, config: dict = None):
+        config = config or dict()
+        return cls(
+            delay = config.get('delay', 3),
+            backoff = config.get('backoff', 2),
+            max_delay = config.get('max-delay', 300),
+            max_time = config.get('max-time', 1500),
+            failures = config.get('failures', 5),
+            cooldown = config.get('cooldown', 900),
+            timeout = config.get('timeout', 30))
+
+    def retry_delay(self, failures):
+        delay = min(self.max_delay, self.delay * self.backoff ** (failures - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def breaker(self):
+        return CircuitBreaker(self)
+
+
+class CircuitBreaker:
+    '''Failures of a single source.
+
+    Requests must call `check` before and `success` or `failure` after.
+    When the circuit is open, `check` raises CircuitOpen. After the cooldown
+    a single request is let through, it closes the circuit if it succeeds or
+    opens it again.
+    '''
+
+    def __init__(self, policy: RetryPolicy):
+        self.policy = policy
+        self.failures = 0               # failures in a row
+        self.first_failure = None
+        self.opened_until = 0
+        self.lock = Lock()
+
+    def check(self, name=''):
+        with self.lock:
+            if self.failures < self.policy.failures:
+                return
+            now = time.monotonic()
+            if now < self.opened_until:
+                raise CircuitOpen(f'{name} failed {self.failures} times, not requested for {self.opened_until - now:.0f} seconds')
+            # let one request through, others wait for its result
+            self.opened_until = now + self.policy.cooldown
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.first_failure = None
+            self.opened_until = 0
+
+    def failure(self):
+        with self.lock:
+            now = time.monotonic()
+            self.failures += 1
+            if self.first_failure is None:
+                self.first_failure = now
+            if self.failures >= self.policy.failures:
+                self.opened_until = now + self.policy.cooldown
+
+    def next_check(self, interval):
+        'Seconds to wait before the next check of a source that is checked every `interval` seconds'
+        with self.lock:
+            if not self.failures:
+                return interval
+            now = time.monotonic()
+            if self.failures >= self.policy.failures:
+                return max(interval, self.opened_until - now)
+            delay = self.policy.retry_delay(self.failures)
+            if now + delay - self.first_failure > self.policy.max_time:
+                return interval     # gave up retrying
+            return min(interval, delay)
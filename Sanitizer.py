@@ -0,0 +1,463 @@
+'''Clean html for telegram in a single pass
+
+Tags that telegram does not support are dropped, comments are removed and
+only the supported attribute of each tag is kept. The output is the same as
+removing unsupported tags with a regex, parsing the rest with
+BeautifulSoup's html.parser and printing the tree, without building a tree.
+'''
+import re
+from html import unescape
+from html.entities import html5
+from html.parser import (attrfind_tolerant, charref, commentclose, endendtag, endtagfind, entityref,
+                         incomplete, interesting_normal, locatestarttagend_tolerant, piclose, starttagopen,
+                         tagfind_tolerant)
+
+SUPPORTED_HTML_TAGS = ('a', 'b', 'strong', 'i', 'em', 'code', 'pre', 's', 'strike', 'del', 'u')
+SUPPORTED_TAG_ATTRS = {'a': 'href', 'img': 'src', 'pre': 'language'}
+REMOVE = re.compile(r'</?(?!(?:%s)\b)\w+[^>]*/?>' % '|'.join(SUPPORTED_HTML_TAGS))
+REMOVE_IMAGES = re.compile(r'</?(?!(?:%s)\b)\w+[^>]*/?>' % '|'.join(SUPPORTED_HTML_TAGS + ('img',)))
+
+DECLARATION_NAME = re.compile(r'[a-zA-Z][-_.a-zA-Z0-9]*\s*')
+MARKED_SECTION_END = {'temp': re.compile(r']\s*]\s*>'), 'cdata': re.compile(r']\s*]\s*>'),
+                      'ignore': re.compile(r']\s*]\s*>'), 'include': re.compile(r']\s*]\s*>'),
+                      'rcdata': re.compile(r']\s*]\s*>'), 'if': re.compile(r']\s*>'),
+                      'else': re.compile(r']\s*>'), 'endif': re.compile(r']\s*>')}
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+PRESERVE_WHITESPACE = ('pre', 'textarea')
+RAW_TEXT = ('script', 'style')       # text of these tags is not parsed or escaped
+
+
+def _charref(name):
+    'Character of a numeric reference like BeautifulSoup, `name` is like 65 or x41'
+    number = int(name[1:], 16) if name[0] in 'xX' else int(name)
+    if number == 0 or number > 0x10ffff or 0xd800 <= number <= 0xdfff:
+        return '�'
+    if 0x80 <= number <= 0x9f:
+        try:
+            return bytes((number,)).decode('cp1252')    # encoded with windows-1252 by mistake
+        except UnicodeDecodeError:
+            pass
+    return chr(number)
+
+
+def _entityref(name):
+    if name + ';' in html5:
+        return html5[name + ';']
+    if name in html5:
+        return html5[name]
+    return '&' + name
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _attribute(name, value):
+    value = _escape(value)
+    if '"' in value:
+        if "'" in value:
+            return f' {name}="{value.replace(chr(34), "&quot;")}"'
+        return f" {name}='{value}'"
+    return f' {name}="{value}"'
+
+
+def sanitize(html, images=True, found=None) -> str:
+    '''Return telegram-safe html, `img` tags are kept if `images` is true.
+
+    If `found` is a list, a dict is appended to it for each image with its
+    `src`, `link` (href of the `a` that wraps it) and `markup`, the html of
+    the image or of the link that wraps it and no other image.
+
+    The input is tokenized like html.parser does when BeautifulSoup feeds it
+    and then closes it: constructs that are not finished are taken again as
+    text at the end, so their entities are decoded like any other text.'''
+    if not isinstance(html, str):
+        html = str(html)
+    # unsupported tags are removed before tokenizing, like the regex did
+    html = (REMOVE_IMAGES if images else REMOVE).sub('', html)
+    n = len(html)
+    escape = _escape
+    out = []
+    text = []           # decoded text of the current text node
+    stack = []          # [name, index of start tag in out, its images, attributes, images before it]
+    preserve = 0        # open tags that keep whitespace
+    closed_images = 0   # <img> tags that a later </img> closes again
+    raw_text = None     # end of the script or style that is open, its text is not parsed
+
+    def flush():
+        data = ''.join(text)
+        text.clear()
+        if not data:
+            return
+        if not preserve and not data.strip(ASCII_SPACES):
+            data = '\n' if '\n' in data else ' '
+        out.append(data if stack and stack[-1][0] in RAW_TEXT else escape(data))
+
+    def special(prefix, data, suffix):
+        'A doctype, processing instruction, CDATA or declaration'
+        flush()
+        if not preserve and not data.strip(ASCII_SPACES):
+            data = '\n' if '\n' in data else ' '
+        out.append(prefix + data + suffix)
+
+    def close(frame):
+        nonlocal preserve
+        out.append(f'</{frame[0]}>')
+        if frame[0] in PRESERVE_WHITESPACE:
+            preserve -= 1
+        if len(frame[2]) == 1 and len(found) == frame[4] + 1:
+            frame[2][0]['markup'] = ''.join(out[frame[1]:])
+
+    def comment(data):
+        flush()
+        # comments are removed, except empty ones in <pre> like before
+        if preserve and not data:
+            out.append('<!---->')
+
+    def end_tag(name):
+        nonlocal closed_images
+        if name == 'img' and closed_images:
+            closed_images -= 1
+            return
+        flush()
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i][0] == name:
+                while len(stack) > i:
+                    close(stack.pop())
+                break
+
+    def start_tag(i):
+        'Parse a start tag at i, returns the position after it or -1 if it is not finished'
+        nonlocal preserve, closed_images, raw_text
+        match = locatestarttagend_tolerant.match(html, i)
+        endpos = match.end()
+        following = html[endpos:endpos + 1]
+        if following == '>':
+            endpos += 1
+        elif following == '/':
+            if html.startswith('/>', endpos):
+                endpos += 2
+            else:
+                return -1
+        elif following == '' or following in 'abcdefghijklmnopqrstuvwxyz=/ABCDEFGHIJKLMNOPQRSTUVWXYZ':
+            return -1
+        elif endpos <= i:
+            endpos = i + 1
+        # parse attributes like html.parser
+        name_match = tagfind_tolerant.match(html, i + 1)
+        name = name_match.group(1).lower()
+        attrs = dict()
+        k = name_match.end()
+        while k < endpos:
+            attr_match = attrfind_tolerant.match(html, k)
+            if not attr_match:
+                break
+            attr_name, rest, value = attr_match.group(1, 2, 3)
+            if not rest:
+                value = ''
+            elif value[:1] == '\'' == value[-1:] or value[:1] == '"' == value[-1:]:
+                value = value[1:-1]
+            if value:
+                value = unescape(value)
+            attrs[attr_name.lower()] = value
+            k = attr_match.end()
+        end = html[k:endpos].strip()
+        if end not in ('>', '/>'):
+            text.append(html[i:endpos])     # not a tag
+            return endpos
+        flush()
+        attr = SUPPORTED_TAG_ATTRS.get(name)
+        if attr in attrs:
+            tag = f'<{name}{_attribute(attr, attrs[attr])}'
+        elif attr:
+            # the tag keeps all attributes if it does not have its own one
+            tag = f'<{name}{"".join(_attribute(*a) for a in sorted(attrs.items()))}'
+        else:
+            tag = f'<{name}'
+        if name == 'img':
+            out.append(tag + '/>')
+            if end == '>':
+                closed_images += 1
+            if found is not None:
+                image = {'src': attrs.get('src'), 'link': None, 'markup': out[-1]}
+                if stack and stack[-1][0] == 'a':
+                    image['link'] = stack[-1][3].get('href')
+                    stack[-1][2].append(image)
+                found.append(image)
+            return endpos
+        out.append(tag + '>')
+        frame = [name, len(out) - 1, [], attrs, len(found) if found is not None else 0]
+        if name in PRESERVE_WHITESPACE:
+            preserve += 1
+        if end == '/>':
+            close(frame)
+        else:
+            stack.append(frame)
+            if name in RAW_TEXT:
+                raw_text = re.compile(r'</\s*%s\s*>' % name, re.I)
+        return endpos
+
+    def declaration(i):
+        'Parse <! that is not a comment, returns the position after it or -1'
+        if html.startswith('<![', i):
+            match = DECLARATION_NAME.match(html, i + 3)
+            if not match or match.end() == n:
+                return -1
+            section = MARKED_SECTION_END.get(match.group().strip().lower())
+            # html.parser rejects the whole document here, it is kept as text instead
+            match = section.search(html, i + 3) if section else None
+            if not match:
+                return -1
+            data = html[i + 3:match.start()]
+            if data.upper().startswith('CDATA['):
+                special('<![CDATA[', data[len('CDATA['):], ']]>')
+            else:
+                special('<?', data, '?>')
+            return match.end()
+        if html[i:i + 9].lower() == '<!doctype':
+            end = html.find('>', i + 9)
+            if end == -1:
+                return -1
+            special('<!DOCTYPE ', html[i + 2 + len('DOCTYPE '):end], '>\n')
+            return end + 1
+        end = html.find('>', i + 2)
+        if end == -1:
+            return -1
+        comment(html[i + 2:end])
+        return end + 1
+
+    i = 0
+    for final in (False, True):
+        while i < n:
+            match = (raw_text or interesting_normal).search(html, i)
+            if match:
+                j = match.start()
+            elif raw_text:
+                break
+            else:
+                j = n
+            if i < j:
+                text.append(html[i:j])
+            i = j
+            if i == n:
+                break
+            if html[i] == '<':
+                if starttagopen.match(html, i):
+                    k = start_tag(i)
+                elif html.startswith('</', i):
+                    k = -1
+                    if endendtag.search(html, i + 1):
+                        match = endtagfind.match(html, i)
+                        if match:
+                            name = match.group(1).lower()
+                            raw_text = None
+                            end_tag(name)
+                            k = match.end()
+                        else:
+                            name_match = tagfind_tolerant.match(html, i + 2)
+                            if name_match:
+                                end_tag(name_match.group(1).lower())
+                                k = html.find('>', name_match.end()) + 1
+                            elif html.startswith('</>', i):
+                                k = i + 3
+                            else:
+                                k = html.find('>', i + 2) + 1
+                                comment(html[i + 2:k - 1])
+                elif html.startswith('<!--', i):
+                    match = commentclose.search(html, i + 4)
+                    k = -1
+                    if match:
+                        comment(html[i + 4:match.start()])
+                        k = match.end()
+                elif html.startswith('<?', i):
+                    match = piclose.search(html, i + 2)
+                    k = -1
+                    if match:
+                        special('<?', html[i + 2:match.start()], '>')
+                        k = match.end()
+                elif html.startswith('<!', i):
+                    k = declaration(i)
+                elif i + 1 < n:
+                    text.append('<')
+                    k = i + 1
+                else:
+                    break
+                if k < 0:
+                    if not final:
+                        break
+                    # not finished, it is text up to the next > or <
+                    k = html.find('>', i + 1)
+                    if k < 0:
+                        k = html.find('<', i + 1)
+                        if k < 0:
+                            k = i + 1
+                    else:
+                        k += 1
+                    text.append(html[i:k])
+                i = k
+            elif html.startswith('&#', i):
+                match = charref.match(html, i)
+                if match:
+                    text.append(_charref(match.group()[2:-1]))
+                    i = match.end() if html[match.end() - 1] == ';' else match.end() - 1
+                    continue
+                if html.find(';', i) != -1:
+                    text.append('&#')
+                    i += 2
+                break
+            else:
+                match = entityref.match(html, i)
+                if match:
+                    text.append(_entityref(match.group(1)))
+                    i = match.end() if html[match.end() - 1] == ';' else match.end() - 1
+                    continue
+                match = incomplete.match(html, i)
+                if match:
+                    if final and match.group() == html[i:]:
+                        i += 1
+                    break
+                if i + 1 < n:
+                    text.append('&')
+                    i += 1
+                else:
+                    break
+    if i < n and not raw_text:
+        # after a reference that is not finished the rest is text
+        text.append(html[i:])
+    flush()
+    while stack:
+        close(stack.pop())
+    return ''.join(out)
+
+
+# tokens of sanitized html: tags, character references, text
+PIECE = re.compile(r'<[^>]*>|&(?:#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);|[^<&]+|[<&]')
+TAG_NAME = re.compile(r'</?([a-zA-Z][^\s/>]*)')
+
+
+def utf16_length(text):
+    'Length of text as telegram counts it, in UTF-16 code units'
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _width(piece):
+    if piece[0] == '&' and len(piece) > 1:
+        return utf16_length(unescape(piece))
+    return utf16_length(piece)
+
+
+def _cut(text, length):
+    'Longest prefix of text that is at most `length` UTF-16 code units'
+    if len(text.encode('utf-16-le')) == 2 * len(text):
+        return text[:length]
+    for i, char in enumerate(text):
+        length -= 2 if char > '\uffff' else 1
+        if length < 0:
+            return text[:i]
+    return text
+
+
+def visible_length(html):
+    'Length of the text telegram shows for html, without tags'
+    if '<' not in html and '&' not in html:
+        return utf16_length(html)
+    return sum(_width(piece) for piece in PIECE.findall(html) if piece[0] != '<' or len(piece) == 1)
+
+
+def truncate(html, max_length, suffix=''):
+    '''Cut sanitized html so its visible text is at most `max_length` UTF-16
+    code units, returns (html, is cut).
+
+    A cut text ends at its last space if it has one, tags that are still open
+    are closed and `suffix` is added after a space. Tags and character
+    references are never cut.'''
+    # markup is never shorter than its text
+    if utf16_length(html) <= max_length:
+        return html, False
+    budget = max_length - utf16_length(suffix) - 1
+    if budget < 0:
+        budget, suffix = max(0, max_length), None     # no room for the suffix
+    used = 0
+    out = []
+    stack = []      # (name, index of start tag in out)
+    pieces = PIECE.finditer(html)
+    for match in pieces:
+        piece = match.group()
+        if piece[0] == '<' and len(piece) > 1:
+            name = TAG_NAME.match(piece)
+            if name is None or piece.endswith('/>'):
+                pass
+            elif piece[1] == '/':
+                if stack and stack[-1][0] == name.group(1).lower():
+                    stack.pop()
+            else:
+                stack.append((name.group(1).lower(), len(out)))
+            out.append(piece)
+            continue
+        width = _width(piece)
+        if used + width <= budget:
+            out.append(piece)
+            used += width
+            continue
+        # the suffix is not needed if the rest fits in its place
+        rest = used + width
+        for match in pieces:
+            if rest > max_length:
+                break
+            following = match.group()
+            if following[0] != '<' or len(following) == 1:
+                rest += _width(following)
+        if rest <= max_length:
+            return html, False
+        if piece[0] != '&' or len(piece) == 1:
+            piece = _cut(piece, budget - used)
+            space = piece.rfind(' ')
+            piece = (piece if space == -1 else piece[:space]).rstrip()
+            if piece:
+                out.append(piece)
+        break
+    else:
+        return html, False
+    # tags that were opened right before the cut are empty
+    while stack and stack[-1][1] == len(out) - 1:
+        stack.pop()
+        out.pop()
+    for name, index in reversed(stack):
+        out.append(f'</{name}>')
+    if suffix is not None:
+        out.append(' ' + _escape(suffix))
+    return ''.join(out), True
+
+
+def split(html, separator):
+    '''Split sanitized html at the first `separator`, returns (left, right).
+
+    Tags that are open at the separator are closed at the end of left and
+    opened again at the start of right, so both are balanced. Tags that would
+    be empty on either side are dropped.'''
+    left, right = html.split(separator, 1)
+    out = []
+    stack = []      # (name, start tag, index of start tag in out)
+    for piece in PIECE.findall(left):
+        if piece[0] == '<' and len(piece) > 1:
+            name = TAG_NAME.match(piece)
+            if name is None or piece.endswith('/>'):
+                pass
+            elif piece[1] == '/':
+                if stack and stack[-1][0] == name.group(1).lower():
+                    stack.pop()
+            else:
+                stack.append((name.group(1).lower(), piece, len(out)))
+        out.append(piece)
+    if not stack:
+        return left, right
+    reopen = [tag for name, tag, index in stack]
+    while reopen and right.startswith(f'</{stack[len(reopen) - 1][0]}>'):
+        right = right[len(stack[len(reopen) - 1][0]) + 3:]
+        reopen.pop()
+    for name, tag, index in reversed(stack):
+        if index == len(out) - 1:
+            out.pop()
+        else:
+            out.append(f'</{name}>')
+    return ''.join(out), ''.join(reopen) + right
@@ -0,0 +1,234 @@
+'''Send a broadcast from several processes
+
+Chats are split into shards by a hash of their id and each shard is sent by
+its own process, which reads the chats from the lmdb env of the bot in
+read-only mode. All processes share a single global rate and flood control.
+Results go back to the bot process, which is the only writer of the
+database: it removes blocked chats, stores file_ids and saves the progress of
+each shard in the broadcast job.
+'''
+import logging
+import multiprocessing
+import queue
+import time
+from collections import deque
+
+import lmdb
+from telegram import Bot
+from telegram.utils.request import Request
+
+import BugReporter
+import Chats
+import Delivery
+import Jobs
+import Storage
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(processName)s - %(levelname)s - %(message)s'
+
+
+def _shared(index, none=False):
+    'A float attribute stored in `self.state`, negative values are None if `none` is true'
+    def get(self):
+        value = self.state[index]
+        return None if none and value < 0 else value
+
+    def set(self, value):
+        self.state[index] = -1 if value is None else value
+    return property(get, set)
+
+
+class SharedTokenBucket(Delivery.TokenBucket):
+    'A token bucket of all sender processes, `state` is (rate, tokens, updated)'
+
+    rate = _shared(0)
+    tokens = _shared(1)
+    updated = _shared(2)
+
+    def __init__(self, state, lock, capacity):
+        self.state = state
+        self.lock = lock
+        self.capacity = capacity
+
+    def consume(self, tokens=1):
+        '''Take tokens now and wait until they are available. Waiting callers
+        have negative tokens, so they are served in order instead of the
+        process that wakes up first taking every new token.'''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate) - tokens
+            self.updated = now
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def set_rate(self, rate, empty=False):
+        'Change the rate, saved tokens are dropped if `empty` is true but waiting callers keep their turn'
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            if empty:
+                self.tokens = min(0, self.tokens)
+            self.updated = now
+            self.rate = rate
+
+
+class SharedFloodControl(Delivery.FloodControl):
+    '''Flood control of all sender processes, `state` is (base_rate, throttled,
+    paused_until). Stats and throughput are of this process.'''
+
+    base_rate = _shared(0)
+    throttled = _shared(1, none=True)
+    paused_until = _shared(2)
+
+    def __init__(self, state, lock, max_rate, min_rate=1, decrease=0.5, recovery=1, window=10):
+        self.state = state
+        self.lock = lock
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.decrease = decrease
+        self.recovery = recovery
+        self.window = window
+        self.sent_times = deque()
+        self.started = time.monotonic()
+        self.stats = {'sent': 0, 'retry-after': 0, 'paused': 0.0, 'ceiling': None}
+
+
+class _Progress:
+    'Queue of the job of a shard, sends its progress to the bot process'
+
+    def __init__(self, shard, results, checkpoint):
+        self.shard = shard
+        self.results = results
+        self.checkpoint = checkpoint
+        self.reported = 0
+
+    def save(self, job):
+        self.results.put(('progress', self.shard, job.cursor, list(job.done), job.chats - self.reported))
+        self.reported = job.chats
+
+
+def sender(shard, config, messages, file_ids, job_id, job, subscribers, shared, results):
+    '''Deliver `messages` to the chats of a shard, runs in a sender process.
+
+    `file_ids` are the stored file_ids of their images (src => file_id).
+
+    `job` is the record of the broadcast job without its payload, chats that
+    are done in it are skipped.'''
+    logging.basicConfig(format=LOG_FORMAT, filename=config['log-file'], level=config['log-level'])
+    logger = logging.getLogger('RSSBot')
+    engine = Delivery.DeliveryEngine.from_config(config['delivery'])
+    bucket_state, bucket_lock, flood_state, flood_lock = shared
+    engine.global_bucket = SharedTokenBucket(bucket_state, bucket_lock, engine.global_bucket.capacity)
+    engine.flood = SharedFloodControl(flood_state, flood_lock, engine.flood.max_rate)
+    bot = Bot(config['token'], request=Request(**dict(config['request'], con_pool_size=engine.workers + 4)))
+    if config['base-url']:
+        bot.base_url = config['base-url']
+
+    previous = Jobs.BroadcastJob(None, job_id, **job)
+    progress = Jobs.BroadcastJob(_Progress(shard, results, config['checkpoint']), job_id, previous.kind, None)
+
+    def chats():
+        env = lmdb.open(config['db-path'], readonly=True, map_size=config['db-map-size'], max_dbs=8)
+        try:
+            chats_db = env.open_db(b'chats', create=False)
+            with env.begin(chats_db) as txn:
+                for key, value in txn.cursor():
+                    chat_id = key.decode()
+                    if Chats.shard_of(chat_id, previous.shards) != shard or previous.is_done(chat_id):
+                        continue
+                    if subscribers is not None and chat_id not in subscribers:
+                        continue
+                    try:
+                        data = Chats.decode_header(value)
+                    except Exception:
+                        continue        # removed by the bot process
+                    yield chat_id, data
+        finally:
+            env.close()
+
+    def stored(src, file_id):
+        results.put(('file', src, file_id) if file_id else ('bad-file', src))
+
+    def blocked(chat_id, chat_data, e):
+        logger.info(f'Chat {chat_id} blocked the bot')
+        results.put(('blocked', chat_id))
+
+    def failed(chat_id, chat_data, msg, e):
+        logger.exception(f'Exception while sending a feed to {chat_id}')
+        info = BugReporter.exception('', e, report=False)
+        results.put(('failed', chat_id, info['tag'], info['tb_string']))
+
+    feed_sender = Delivery.FeedSender(messages, file_ids, lambda template, chat_id: Delivery.post(bot, template, chat_id), stored, blocked, failed)
+    stats = engine.broadcast(progress.pending(chats()), feed_sender.deliver, progress)
+    progress.queue.save(progress)
+    results.put(('done', shard, stats))
+
+
+class ShardedDelivery:
+    '''Start a sender process for each shard of a broadcast.
+
+    The processes are started for each broadcast, their rate and flood
+    control are shared by all broadcasts.
+    '''
+
+    def __init__(self, processes, token, db_path, request_kwargs=None, base_url=None, delivery_configs=None, db_map_size=None):
+        self.processes = processes
+        self.context = multiprocessing.get_context('spawn')     # lmdb envs must not be forked
+        delivery_configs = delivery_configs or dict()
+        rate = delivery_configs.get('global-rate', Delivery.GLOBAL_RATE)
+        root = logging.getLogger()
+        self.config = {
+            'token': token,
+            'base-url': base_url,
+            'request': {k: v for k, v in (request_kwargs or dict()).items() if k != 'con_pool_size'},
+            'db-path': db_path,
+            'db-map-size': db_map_size or Storage.MAP_SIZE,
+            'delivery': delivery_configs,
+            'checkpoint': max(1, delivery_configs.get('checkpoint', 100)),
+            'log-level': root.level,
+            'log-file': next((h.baseFilename for h in root.handlers if isinstance(h, logging.FileHandler)), None)
+        }
+        self.shared = (
+            self.context.RawArray('d', [rate, max(1, rate), time.monotonic()]),
+            self.context.Lock(),
+            self.context.RawArray('d', [rate, -1, 0]),
+            self.context.Lock())
+        self.logger = logging.getLogger('RSSBot')
+
+    def broadcast(self, job, messages, file_ids, subscribers=None):
+        '''Send `messages` to the chats of `job` that are not done and yield
+        results of the processes until all of them are done:
+
+        - ('progress', shard, cursor, done, chats)
+        - ('blocked', chat_id)
+        - ('failed', chat_id, tag, traceback)
+        - ('file', src, file_id) and ('bad-file', src)
+        - ('done', shard, stats) or ('crashed', shard, exitcode)
+        '''
+        results = self.context.Queue()
+        record = dict(job.record(), payload=None)
+        processes = [
+            self.context.Process(
+                target = sender,
+                args = (shard, self.config, messages, file_ids, job.id, record, subscribers, self.shared, results),
+                name = f'shard-{shard}',
+                daemon = True)
+            for shard in range(job.shards)]
+        for process in processes:
+            process.start()
+        running = set(range(job.shards))
+        while running:
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                # a process that stopped has put all of its results
+                for shard in list(running):
+                    if not processes[shard].is_alive():
+                        running.discard(shard)
+                        yield ('crashed', shard, processes[shard].exitcode)
+                continue
+            if result[0] == 'done':
+                running.discard(result[1])
+            yield result
+        for process in processes:
+            process.join()
@@ -0,0 +1,124 @@
+import logging
+import struct
+import time
+from threading import Lock, Timer
+
+# the database keeps chats, feeds, renders and broadcast jobs, lmdb can not grow
+# past its map size (10MiB by default). The file only takes the space it uses.
+MAP_SIZE = 1024*1024*1024
+
+class WriteBatch:
+    '''Group lmdb writes in a single write transaction.
+
+    Operations are callables that receive a write transaction. Queued
+    operations are applied in order when `size` of them are waiting,
+    `interval` seconds after the first one was queued, or on `flush`.
+    '''
+
+    def __init__(self, env, size=1000, interval=1.0):
+        self.env = env
+        self.size = size
+        self.interval = interval
+        self.operations = []
+        self.lock = Lock()
+        self.flush_lock = Lock()        # keeps order of transactions
+        self.timer = None
+        self.logger = logging.getLogger('RSSBot')
+
+    def add(self, operation):
+        with self.lock:
+            self.operations.append(operation)
+            full = len(self.operations) >= self.size
+            if not full and self.timer is None:
+                self.timer = Timer(self.interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                operations, self.operations = self.operations, []
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+            if not operations:
+                return
+            with self.env.begin(write=True) as txn:
+                for operation in operations:
+                    try:
+                        operation(txn)
+                    except Exception:
+                        self.logger.exception('Exception in a batched write')
+            self.logger.debug(f'Flushed {len(operations)} writes')
+
+    def close(self):
+        self.flush()
+
+
+class SeenIndex:
+    '''Fingerprints of feeds that were seen, for each source.
+
+    Keys are a prefix of the source and the fingerprint, values are the time
+    a feed was last seen, so a lookup is a single get. Feeds that were not
+    seen for `max_age` seconds are removed by `evict`.
+    '''
+
+    def __init__(self, env, db, max_age=30*24*3600, evict_interval=3600):
+        self.env = env
+        self.db = db
+        self.max_age = max_age
+        self.evict_interval = evict_interval
+        self.evicted = dict()       # source url => time of last eviction
+        self.logger = logging.getLogger('RSSBot')
+
+    def __prefix(self, source):
+        return source.key('seen').encode() + b'\0'
+
+    def last_seen(self, source, fingerprint):
+        'Time that a feed was last seen, or None if it is new'
+        with self.env.begin(self.db) as txn:
+            value = txn.get(self.__prefix(source) + fingerprint)
+        return struct.unpack('<d', value)[0] if value is not None else None
+
+    def is_empty(self, source):
+        prefix = self.__prefix(source)
+        with self.env.begin(self.db) as txn:
+            cursor = txn.cursor()
+            return not (cursor.set_range(prefix) and cursor.key().startswith(prefix))
+
+    def add(self, source, fingerprints, now=None, txn=None):
+        'Mark feeds as seen, they are written in `txn` if it is given'
+        if not fingerprints:
+            return
+        prefix = self.__prefix(source)
+        value = struct.pack('<d', now or time.time())
+        if txn is not None:
+            for fingerprint in fingerprints:
+                txn.put(prefix + fingerprint, value, db = self.db)
+            return
+        with self.env.begin(self.db, write=True) as txn:
+            for fingerprint in fingerprints:
+                txn.put(prefix + fingerprint, value)
+
+    def evict(self, source, now=None):
+        'Remove feeds of a source that were not seen for max_age seconds'
+        now = now or time.time()
+        if now - self.evicted.get(source.url, 0) < self.evict_interval:
+            return 0
+        self.evicted[source.url] = now
+        prefix = self.__prefix(source)
+        removed = 0
+        with self.env.begin(self.db, write=True) as txn:
+            cursor = txn.cursor()
+            if cursor.set_range(prefix):
+                while cursor.key().startswith(prefix):
+                    if now - struct.unpack('<d', cursor.value())[0] > self.max_age:
+                        cursor.delete()     # moves to the next entry
+                        removed += 1
+                    elif not cursor.next():
+                        break
+        if removed:
+            self.logger.info(f'Removed {removed} old seen feeds of {source.url}')
+        return removed
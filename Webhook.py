@@ -0,0 +1,119 @@
+import hmac
+import json
+import logging
+import signal
+import ssl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread
+
+from telegram import Update
+
+MAX_UPDATE_SIZE = 1024*1024
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def wait_for_signal(stop_signals=(signal.SIGINT, signal.SIGTERM, signal.SIGABRT)):
+    'Block until one of `stop_signals` is received'
+    stopped = Event()
+    for sig in stop_signals:
+        signal.signal(sig, lambda signum, frame: stopped.set())
+    while not stopped.wait(1):
+        pass
+
+
+class WebhookServer:
+    '''A small http server that receives updates from telegram and puts them in
+    the dispatcher queue.
+
+    Requests must use `path` and, if `secret_token` is set, carry it in the
+    X-Telegram-Bot-Api-Secret-Token header.
+    '''
+
+    def __init__(self, bot, dispatcher, listen='0.0.0.0', port=8443, path='/', url=None,
+            secret_token=None, max_connections=40, cert=None, key=None):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.address = (listen, port)
+        self.path = path
+        self.url = url
+        self.secret_token = secret_token
+        self.max_connections = max_connections
+        self.cert = cert
+        self.key = key
+        self.httpd = None
+        self.thread = None
+        self.logger = logging.getLogger('RSSBot')
+
+    @classmethod
+    def from_config(cls, bot, dispatcher, config: dict):
+        return cls(
+            bot, dispatcher,
+            listen = config.get('listen', '0.0.0.0'),
+            port = config.get('port', 8443),
+            path = config.get('path', '/'),
+            url = config.get('url'),
+            secret_token = config.get('secret-token'),
+            max_connections = config.get('max-connections', 40),
+            cert = config.get('cert'),
+            key = config.get('key'))
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    return self.send_error(404)
+                if server.secret_token and not hmac.compare_digest(
+                        self.headers.get(SECRET_HEADER, ''), server.secret_token):
+                    return self.send_error(403)
+                length = int(self.headers.get('Content-Length', 0))
+                if not 0 < length <= MAX_UPDATE_SIZE:
+                    return self.send_error(413 if length else 400)
+                try:
+                    data = json.loads(self.rfile.read(length))
+                    update = Update.de_json(data, server.bot)
+                except Exception:
+                    server.logger.exception('Bad update received by webhook')
+                    return self.send_error(400)
+                server.dispatcher.update_queue.put(update)
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                server.logger.debug('webhook: ' + format % args)
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            # telegram opens up to max-connections at the same time
+            request_queue_size = max(128, self.max_connections)
+
+        self.httpd = Server(self.address, Handler)
+        if self.cert:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.cert, self.key)
+            self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+        self.thread = Thread(target=self.httpd.serve_forever, name='webhook')
+        self.thread.start()
+        self.logger.info(f'Webhook server listening on {self.address[0]}:{self.address[1]}{self.path}')
+
+        if self.url:
+            api_kwargs = {'secret_token': self.secret_token} if self.secret_token else None
+            certificate = open(self.cert, 'rb') if self.cert else None
+            try:
+                self.bot.set_webhook(
+                    self.url,
+                    certificate = certificate,
+                    max_connections = self.max_connections,
+                    api_kwargs = api_kwargs)
+            finally:
+                if certificate:
+                    certificate.close()
+            self.logger.info(f'Webhook set to {self.url}')
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.thread.join()
+            self.httpd.server_close()
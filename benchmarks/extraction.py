@@ -0,0 +1,104 @@
+'''Per-item cost of extracting feeds, before and after the compiled extraction plan
+
+    python3 benchmarks/extraction.py [items]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bs4
+from bs4 import BeautifulSoup as Soup
+
+import Feeds
+
+CONFIGS = {
+    'source': 'http://localhost/rss',
+    'feeds-selector': 'item',
+    'time-selector': 'pubDate',
+    'time-attribute': None,
+    'link-selector': 'link',
+    'link-attribute': None,
+    'title-selector': 'title',
+    'title-attribute': None,
+    'content-selector': 'description',
+    'feed-skip-condition': 'title/^Skip',
+}
+
+
+def make_feed(items):
+    feeds = ''.join(
+        f'<item><title>{"Skip" if i % 10 == 0 else "Post"} {i}</title><link>https://example.com/{i}</link>'
+        f'<pubDate>Mon, 09 Jan 2024 10:00:00 GMT</pubDate><category>news</category>'
+        f'<description>&lt;p&gt;Paragraph &lt;b&gt;{i}&lt;/b&gt; with &lt;a href="https://example.com"&gt;a link&lt;/a&gt;&lt;/p&gt;</description></item>'
+        for i in range(items))
+    return f'<?xml version="1.0"?><rss><channel><title>Bench</title>{feeds}</channel></rss>'
+
+
+def legacy_extract(source, feed):
+    'read_feed before the extraction plan, kept here for comparison'
+    title, link, content, time = None, None, None, None
+    if source.skip_field == 'feed':
+        if source.skip(feed):
+            return None
+    title_selector = source['title-selector']
+    if title_selector:
+        if source['title-attribute']:
+            title = str(feed.select_one(title_selector).attrs[source['title-attribute']])
+        else:
+            title = str(feed.select_one(title_selector).text)
+        if source.skip_field == 'title':
+            if source.skip(title):
+                return None
+    link_selector = source['link-selector']
+    if link_selector:
+        if source['link-attribute']:
+            link = str(feed.select_one(link_selector).attrs[source['link-attribute']])
+        else:
+            link = str(feed.select_one(link_selector).text)
+        if source.skip_field == 'link':
+            if source.skip(link):
+                return None
+    time_selector = source['time-selector']
+    if source['time-attribute']:
+        time = str(feed.select_one(time_selector).attrs[source['time-attribute']])
+    else:
+        time = str(feed.select_one(time_selector).text)
+    content_selector = source['content-selector']
+    if content_selector:
+        tag = feed.select(content_selector)[0]
+        html = tag.string if isinstance(tag, bs4.NavigableString) else ''.join([str(c) for c in tag.contents])
+        content = Soup(html, features='lxml')
+        if source.skip_field == 'content':
+            if source.skip(content):
+                return None
+    return {'title': title, 'link': link, 'content': content, 'date': time}
+
+
+def measure(extract, feeds, rounds=5):
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        results = [extract(feed) for feed in feeds]
+        best = min(best, time.perf_counter() - start)
+    return best / len(feeds), results
+
+
+def main(items=500):
+    feeds = Soup(make_feed(items), 'xml').select('item')
+    results = []
+    for configs in (CONFIGS, dict(CONFIGS, **{'content-selector': None})):
+        source = Feeds.FeedSource(configs)
+        before, expected = measure(lambda feed: legacy_extract(source, feed), feeds)
+        after, got = measure(source.plan, feeds)
+        assert [r and (r['title'], r['link'], r['date'], str(r['content'])) for r in expected] == \
+            [r and (r['title'], r['link'], r['date'], str(r['content'])) for r in got]
+        results.append((configs['content-selector'], before, after))
+    print(f'{items} items, best of 5 rounds')
+    for content_selector, before, after in results:
+        print(f'content-selector={content_selector!s:12} before: {before*1e6:8.1f}us/item  after: {after*1e6:8.1f}us/item  ({before/after:.1f}x)')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
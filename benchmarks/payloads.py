@@ -0,0 +1,84 @@
+'''Requests per second of one core to send a broadcast message to each chat,
+with the methods of python-telegram-bot and with Delivery.RequestTemplate
+
+    python3 benchmarks/payloads.py
+
+Telegram is replaced by a canned response, so this is the CPU of building,
+encoding and parsing a request, not the network.
+'''
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
+from telegram.utils.request import Request
+
+import Delivery
+
+CHATS = 20000
+MESSAGE = {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': 'sent'}
+PHOTO = dict(MESSAGE, photo=[{'file_id': 'AgACAgQAAxkBAAI', 'file_unique_id': 'u', 'width': 800, 'height': 600}])
+FILE_IDS = {f'https://example.com/{i}.png': f'AgACAgQAAxkBAAI{i}' for i in range(5)}
+RESPONSES = {
+    'sendMessage': json.dumps({'ok': True, 'result': MESSAGE}).encode(),
+    'sendPhoto': json.dumps({'ok': True, 'result': PHOTO}).encode(),
+    'sendMediaGroup': json.dumps({'ok': True, 'result': [PHOTO] * 5}).encode()}
+
+
+class CannedRequest(Request):
+    'Answers every request without sending it'
+
+    def _request_wrapper(self, method, url, **kwargs):
+        return RESPONSES[url.rsplit('/', 1)[1]]
+
+
+def messages():
+    markup = [[InlineKeyboardButton('Go to post', 'https://example.com/posts/1')]]
+    text = '<a href="https://example.com/posts/1"><b>A post</b></a>\n' + 'Some text of the post. ' * 150
+    images = [{'type': 'image', 'src': f'https://example.com/{i}.png', 'text': f'image {i}', 'markup': []} for i in range(5)]
+    return {
+        'text': {'type': 'text', 'text': text, 'markup': markup},
+        'photo': dict(images[0], text=text[:1000], markup=markup),
+        'album': {'type': 'album', 'images': images, 'markup': []}}
+
+
+def bot_method(bot, msg):
+    'send_feed before request templates'
+    def send(chat_id):
+        reply_markup = InlineKeyboardMarkup(msg['markup']) if msg['markup'] else None
+        if msg['type'] == 'text':
+            bot.send_message(chat_id, msg['text'], parse_mode=ParseMode.HTML,
+                reply_markup=reply_markup, disable_web_page_preview=True)
+        elif msg['type'] == 'image':
+            bot.send_photo(chat_id, FILE_IDS[msg['src']], msg['text'], parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+        else:
+            bot.send_media_group(chat_id, Delivery.album_media(msg, FILE_IDS))
+    return send
+
+
+def template(bot, msg):
+    templates = Delivery.RequestTemplates(FILE_IDS)
+    return lambda chat_id: Delivery.post(bot, templates.get(msg), chat_id)
+
+
+def run(send):
+    start = time.process_time()
+    for chat_id in range(CHATS):
+        send(str(100000000 + chat_id))
+    return CHATS / (time.process_time() - start)
+
+
+def main():
+    bot = Bot('123456:benchmark', request=CannedRequest())
+    print(f'{"message":<8} {"bot method":>12} {"template":>12} {"speedup":>8}   requests/s of one core')
+    for name, msg in messages().items():
+        old = run(bot_method(bot, msg))
+        new = run(template(bot, msg))
+        print(f'{name:<8} {old:>12.0f} {new:>12.0f} {new / old:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
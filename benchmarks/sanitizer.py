@@ -0,0 +1,113 @@
+'''Compare Sanitizer.sanitize with the old regex + html.parser purge
+
+Checks that both give the same output on a golden corpus and prints the
+throughput of each.
+
+    python3 benchmarks/sanitizer.py
+'''
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bs4 import BeautifulSoup as Soup
+from bs4 import Comment
+
+import Sanitizer
+
+GOLDEN = [
+    '<p>Hello <b>world</b></p>',
+    'a &amp; b &lt; c &gt; d &quot; &nbsp; &#169; &#x41; &#150; &foo; x&amp-y AT&T',
+    '<a href="https://example.com/?a=1&amp;b=2" class="c" target="_blank">link</a>',
+    '<b>x</b>\n\n  <i>y</i>',
+    '<pre language="python">  a\n\n  </pre><pre>\n</pre><pre><!----></pre>',
+    '<!-- comment --> text <!-- <div> -->',
+    '<img src="https://example.com/a.png" width="100"><img src="b.png"></img>',
+    '<a href="https://example.com"><img src="https://example.com/c.png"/></a>',
+    '<b><i>x</b> y</i></b>stray</a>',
+    '<b/>x<pre language="x" />y',
+    '<strike>s</strike><s>s</s><del>d</del><u>u</u><abbr>x</abbr><bold>q</bold><a-x>y</a-x>',
+    '<a href=\'say "hi"\'>q</a><a href="it\'s &quot;x&quot;">q</a><a href>e</a><a href="1" href="2">d</a>',
+    '<a class="x" title="no href">q</a><img alt="no src"/>',
+    '<B>upper</B><!DOCTYPE html><p>x</p><?xml version="1.0"?>',
+    '<![CDATA[ a <div> b ]]>x < y and z > w',
+    '<code>1 &lt; 2</code>\n<b>\t</b>  ',
+    'tail &amp',
+    'AT&T',
+    # constructs that are not finished are parsed again as text
+    'if x<y &amp; z is true',
+    '<p>a<b &amp; c</p>',
+    '<i&#65; <!&amp; <?&lt; </&foo;',
+    '<!--> a <!-- b',
+    '&#q &#z <b>;</b>',
+    '&nbsp- &nbsp &a',
+    '<?><!DOCTYPE><![if x]>y<![CDATA[ z',
+    '<pre><!></pre><p><?></p>',
+    '<<x>script>a &amp; <b>c</b></script>d',
+]
+
+
+def legacy_purge(html, images=True):
+    'BotHandler.purge before the single pass sanitizer'
+    tags = '|'.join(Sanitizer.SUPPORTED_HTML_TAGS)
+    if images:
+        tags += '|img'
+    if not isinstance(html, str):
+        html = str(html)
+    pattern = r'</?(?!(?:%s)\b)\w+[^>]*/?>' % tags
+    purge = re.compile(pattern).sub
+    soup = Soup(purge('', html), 'html.parser')
+    comments = soup.find_all(string=lambda text: isinstance(text, Comment))
+    for c in comments:
+        c.extract()
+    for tag in soup.descendants:
+        if tag.name in Sanitizer.SUPPORTED_TAG_ATTRS:
+            attr = Sanitizer.SUPPORTED_TAG_ATTRS[tag.name]
+            if attr in tag.attrs:
+                tag.attrs = {attr: tag[attr]}
+        else:
+            tag.attrs = dict()
+    return soup
+
+
+def make_post(i):
+    'A post like the content of a blog feed, as it is given to purge'
+    html = ''.join(
+        f'<h2 id="s{i}-{j}">Section {j}</h2>'
+        f'<p class="text">Paragraph <b>{i}</b> with <a href="https://example.com/{i}?a=1&amp;b={j}" rel="nofollow">a link</a>, '
+        f'<em>emphasis</em>, <span style="color: red">styled &amp; quoted &quot;text&quot;</span> and &#8211; entities&nbsp;here.</p>'
+        f'<!-- generated --><figure><a href="https://example.com/img/{j}"><img src="https://example.com/{i}/{j}.png" width="640" alt="image"/></a>'
+        f'<figcaption>Caption {j}</figcaption></figure>'
+        f'<ul><li>item <code>x &lt; {j}</code></li><li>item <strong>two</strong></li></ul>'
+        f'<pre language="python">for i in range({j}):\n    print(i)</pre><br/>\n'
+        for j in range(8))
+    return str(Soup(html, 'lxml'))
+
+
+def measure(function, corpus, rounds=3):
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for html in corpus:
+            function(html)
+        best = min(best, time.perf_counter() - start)
+    return sum(len(html) for html in corpus) / best
+
+
+def main():
+    posts = [make_post(i) for i in range(50)]
+    for html in GOLDEN + posts:
+        for images in (True, False):
+            expected, got = str(legacy_purge(html, images)), Sanitizer.sanitize(html, images)
+            assert expected == got, f'different output for {html!r}:\n{expected!r}\n{got!r}'
+    print(f'same output on {len(GOLDEN) + len(posts)} documents')
+
+    before = measure(lambda html: str(legacy_purge(html)), posts)
+    after = measure(Sanitizer.sanitize, posts)
+    print(f'before: {before/1e6:6.2f} MB/s  after: {after/1e6:6.2f} MB/s  ({after/before:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
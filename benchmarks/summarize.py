@@ -0,0 +1,73 @@
+'''Time to cut long posts to a telegram message, before and after Sanitizer.truncate
+
+    python3 benchmarks/summarize.py
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bs4 import BeautifulSoup as Soup
+
+import Sanitizer
+
+READ_MORE = 'read more ...'
+
+
+def legacy_summarize(soup, max_length, read_more):
+    'BotHandler.summarize before the truncation engine, kept here for comparison'
+    trim = len(read_more)
+    len_ = len(str(soup))
+    if len_>max_length:
+        trim += len_ - max_length
+        removed = 0
+        for element in reversed(list(soup.descendants)):
+            if (not element.name) and len(str(element))>trim-removed:
+                s = str(element)
+                wrap_index = s.rfind(' ',0 , trim-removed)
+                if wrap_index == -1:
+                    element.replace_with(s[:-trim+removed])
+                    removed = trim
+                else:
+                    element.replace_with(s[:wrap_index])
+                removed = trim
+            else:
+                element.replace_with('')
+                removed += len(str(element))
+            if removed >= trim:
+                break
+        soup.append(read_more)
+    return str(soup), len_>max_length
+
+
+def make_post(size):
+    paragraph = ('<b>Paragraph</b> with <a href="https://example.com/?a=1&amp;b=2">a link</a>, '
+                 '<i>emphasis &amp; entities</i>, ünïcödé and 😀 emoji. <code>x &lt; y</code>\n')
+    html = paragraph * (size // len(paragraph) + 1)
+    return Sanitizer.sanitize(html)
+
+
+def measure(function, rounds=3):
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    for size in (10_000, 25_000, 50_000, 100_000):
+        html = make_post(size)
+        text, cut = Sanitizer.truncate(html, 4096, READ_MORE)
+        assert cut and Sanitizer.visible_length(text) <= 4096
+        assert Sanitizer.sanitize(text) == text, 'truncated html is not well formed'
+        after = measure(lambda: Sanitizer.truncate(html, 4096, READ_MORE))
+        before = measure(lambda: legacy_summarize(Soup(html, 'html.parser'), 4096, READ_MORE), rounds=1)
+        parse = measure(lambda: Soup(html, 'html.parser'), rounds=1)
+        print(f'{len(html)//1000:4d}KB  before: {before - parse:9.1f}ms  after: {after:6.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,81 +1,47 @@
 import argparse
+import hashlib
 import html
+import json
 from xml.sax.handler import feature_external_ges
-import bs4
 import commentjson
 import logging
 import os
 import pickle
-import re
 import sys
+from itertools import islice
+from threading import Thread
 
 from telegram.files.document import Document
 import BugReporter
+import Cache
+import Chats
+import Delivery
+import Feeds
 import Handlers
+import Http
+import Images
+import Jobs
+import Notifier
+import Retry
+import Sanitizer
+import Shards
+import Storage
+import Webhook
 import io
-from threading import Timer
-from urllib.request import urlopen
 import lmdb
 from bs4 import BeautifulSoup as Soup
-from bs4 import Comment
 from dateutil.parser import parse as parse_date
-from telegram import (InlineKeyboardButton, InlineKeyboardMarkup,ParseMode)
-from telegram.error import Unauthorized
+from telegram import (InlineKeyboardButton, ParseMode)
 from telegram.ext import Updater
 
 
 import time
-from functools import wraps
-
-
-def retry(tries=4, delay=3, backoff=2):
-    """Retry calling the decorated function using an exponential backoff.
-
-    http://www.saltycrane.com/blog/2009/11/trying-out-retry-decorator-python/
-    original from: http://wiki.python.org/moin/PythonDecoratorLibrary#Retry
-
-    :param ExceptionToCheck: the exception to check. may be a tuple of
-        exceptions to check
-    :type ExceptionToCheck: Exception or tuple
-    :param tries: number of times to try (not retry) before giving up
-    :type tries: int
-    :param delay: initial delay between retries in seconds
-    :type delay: int
-    :param backoff: backoff multiplier e.g. value of 2 will double the delay
-        each retry
-    :type backoff: int
-    :param logger: logger to use. If None, print
-    :type logger: logging.Logger instance
-    """
-    def deco_retry(f):
-
-        @wraps(f)
-        def f_retry(*args, **kwargs):
-            mtries, mdelay = tries, delay
-            while mtries > 1:
-                try:
-                    return f(*args, **kwargs)
-                except Exception as e:
-                    msg = "%s, Retrying in %d seconds..." % (str(e), mdelay)
-                    logging.warning(msg)
-                    time.sleep(mdelay)
-                    mtries -= 1
-                    mdelay *= backoff
-            return f(*args, **kwargs)
-
-        return f_retry  # true decorator
-
-    return deco_retry
-
-
 class BotHandler:
 
-    #All supported tags by telegram seprated by '|'
-    # this program will handle images it self
-    SUPPORTED_HTML_TAGS = '|'.join(('a','b','strong','i','em','code','pre','s','strike','del','u'))
-    SUPPORTED_TAG_ATTRS = {'a':'href', 'img':'src', 'pre':'language'}
     MAX_MSG_LEN = 4096
     MAX_CAP_LEN = 1024
+    MAX_ALBUM_SIZE = 10
+    MAX_ALBUM_CAPTION = 200     # longer captions are sent with a single photo
 
     def __init__(
         self,
@@ -87,28 +53,98 @@ class BotHandler:
         strings: dict,
         bug_reporter = False,
         debug = False,
-        request_kwargs=None):
-        
+        request_kwargs=None,
+        delivery_configs=None,
+        feed_workers=4,
+        render_cache_configs=None,
+        last_feed_ttl=300,
+        write_batch_configs=None,
+        runtime='threads',
+        webhook_configs=None,
+        seen_max_age=30,
+        notifier_configs=None,
+        retry_configs=None,
+        image_probe_configs=None,
+        http_configs=None):
+
+        self.logger = logging.getLogger('RSSBot')
+        self.delivery = Delivery.DeliveryEngine.from_config(delivery_configs)
+        # feeds and images are requested through the proxy of the bot too
+        self.http = Http.HttpClient.from_config(http_configs, request_kwargs)
+        # each delivery worker needs its own connection to telegram
+        request_kwargs = dict(request_kwargs or {})
+        request_kwargs.setdefault('con_pool_size', self.delivery.workers + 8)
         self.updater = Updater(Token, request_kwargs=request_kwargs)
         self.bot = self.updater.bot
         self.dispatcher = self.updater.dispatcher
+        self.webhook = Webhook.WebhookServer.from_config(self.bot, self.dispatcher, webhook_configs) if webhook_configs else None
         self.token = Token
         self.env = env
         self.chats_db = chats_db
+        converted, removed = Chats.migrate(env, chats_db)
+        with env.begin(data_db) as txn:
+            stats = Chats.get_stats(txn, data_db)
+        if stats is None or converted or removed:
+            Chats.rebuild_stats(env, chats_db, data_db)
         self.data_db = data_db
+        self.files_db = env.open_db(b'files')      #image url (or a hash of a long one, check file_key) => telegram file_id
+        # images are checked before they are sent as photos, unless it is off
+        self.image_prober = None if image_probe_configs == 'off' else Images.ImageProber.from_config(self.http, image_probe_configs)
+        self.seen = Storage.SeenIndex(env, env.open_db(b'seen'), seen_max_age*24*3600)
+        # broadcasts are kept in database until they are done, so they resume after a restart
+        self.jobs = Jobs.JobQueue(env, env.open_db(b'jobs'), (delivery_configs or dict()).get('checkpoint', 100))
+        self.jobs.register('feed', self.deliver_feed)
+        write_batch_configs = write_batch_configs or dict()
+        self.writes = Storage.WriteBatch(env, write_batch_configs.get('size', 1000), write_batch_configs.get('interval', 1))
         self.adminID = self.get_data('adminID', [], DB = data_db)
         self.ownerID = self.get_data('ownerID', DB = data_db)
         self.admins_pendding = {}
         self.admin_token = []
         self.strings = strings
-        #`source` now is a property of `feed_config`
-        self.feed_configs = feed_configs
-        self.source = feed_configs['source']
+        self.strings_hash = hashlib.sha1(json.dumps(strings, sort_keys = True).encode()).hexdigest()
+        render_cache_configs = render_cache_configs or dict()
+        self.render_cache = Cache.LRUCache(
+            render_cache_configs.get('size', 128),
+            env, env.open_db(b'renders') if render_cache_configs.get('persist') else None)
+        # feed-configs could be a single source or a list of sources
+        if isinstance(feed_configs, dict):
+            feed_configs = [feed_configs]
+        self.retry = Retry.RetryPolicy.from_config(retry_configs)
+        self.feeds = [Feeds.FeedSource(c, self.retry.breaker()) for c in feed_configs]
         self.interval = self.get_data('interval', 5*60, data_db)
-        self.__check = True
+        self.runtime = None
+        if runtime == 'asyncio':
+            try:
+                import AsyncRuntime
+            except ModuleNotFoundError:
+                self.logger.error('aiohttp module not found, please first make sure that it is installed and then use asyncio runtime')
+            else:
+                self.runtime = AsyncRuntime.AsyncRuntime(
+                    self,
+                    (delivery_configs or dict()).get('in-flight', 256),
+                    feed_workers,
+                    request_kwargs)
+        # latest feed of each source, shared by /last_feed requests
+        self.latest_feeds = {
+            source.url: Cache.Snapshot(lambda source=source: next(self.read_feed(source = source), None), last_feed_ttl)
+            for source in self.feeds}
+        self.scheduler = Feeds.FeedScheduler(
+            self.check_new_feed,
+            lambda source: source.breaker.next_check(source.interval or self.interval),
+            feed_workers)
         self.bug_reporter = bug_reporter if bug_reporter else None
+        notifier_configs = notifier_configs or dict()
+        self.notifier = Notifier.OwnerNotifier(
+            self.notify_owner,
+            notifier_configs.get('window', 60),
+            notifier_configs.get('max-reports', 5))
         self.debug = False
-        self.logger = logging.getLogger('RSSBot')
+        # feeds could be sent from a process for each shard of chats
+        self.shards = Shards.ShardedDelivery(
+            (delivery_configs or dict()).get('processes', 1),
+            Token, env.path(), request_kwargs, self.bot.base_url, delivery_configs, env.info()['map_size'])
+        if self.runtime and self.shards.processes > 1:
+            self.logger.error('delivery processes are not used by asyncio runtime')
 
         if debug:
             Handlers.add_debuging_handlers(self)
@@ -119,116 +155,136 @@ class BotHandler:
         Handlers.add_other_handlers(self)
         Handlers.add_unknown_handlers(self)
 
-        # New configurations:
-        # - feed-format: specify feed fromat like xml or ...
-        # - feeds-list-selector: how to find list of all feeds
-        # - title-selector: how to find title
-        # - link-selector: how to get link of source
-        # - content-selector: how to get content
-        # - skip-condition: how to check skip condition
-        #   - format: feed/{selector}, content/{selector}, title/{regex}, link/{regex}, none
-
-        self.__skip = lambda feed: False
-        skip_condition = feed_configs.get('feed-skip-condition')
-        if isinstance(skip_condition, str):
-            self.__skip_field, skip_condition = skip_condition.split('/')
-            if self.__skip_field == 'feed':
-                self.__skip = lambda feed: bool(feed.select(skip_condition))
-            elif self.__skip_field == 'content':
-                self.__skip = lambda content: bool(content.select(skip_condition))
-            elif self.__skip_field == 'title':
-                match = re.compile(skip_condition).match
-                self.__skip = lambda title: bool(match(title))
-            elif self.__skip_field == 'link':
-                match = re.compile(skip_condition).match
-                self.__skip = lambda link: bool(match(link))
-
     def log_bug(self, exc:Exception, msg='', report = True, disable_notification = False,**args):
         info = BugReporter.exception(msg, exc, report = self.bug_reporter and report)
         self.logger.exception(msg, exc_info=exc)
-        msg = html.escape(msg)
-        escaped_info = {k:html.escape(str(v)) for k,v in info.items()}
-        message = (
-            '<b>An exception was raised</b>\n'
-            '<i>L{line_no}@{file_name}: {exc_type}</i>\n'
-            f'{msg}\n\n'
-            '<pre>{tb_string}</pre>'
-        ).format_map(escaped_info)
-
-        if args:
-            message+='\n\nExtra info:'
-            msg+='\n\nExtra info'
-            for key, value in args.items():
-                message+=f'\n<pre>{key} = {html.escape(commentjson.dumps(value, indent = 2, ensure_ascii = False))}</pre>'
-                msg+=f'\n{key} = {commentjson.dumps(value, indent = 2, ensure_ascii = False, default=str)}'
-        
+
+        def build():
+            escaped_info = {k:html.escape(str(v)) for k,v in info.items()}
+            message = (
+                '<b>An exception was raised</b>\n'
+                '<i>L{line_no}@{file_name}: {exc_type}</i>\n'
+                f'{html.escape(msg)}\n\n'
+                '<pre>{tb_string}</pre>'
+            ).format_map(escaped_info)
+
+            if args:
+                message+='\n\nExtra info:'
+                for key, value in args.items():
+                    message+=f'\n<pre>{key} = {html.escape(commentjson.dumps(value, indent = 2, ensure_ascii = False, default=str))}</pre>'
+            return message, '{file_name}_{line_no}.html'.format_map(info)
+
+        # reports are sent by a background thread, repeated ones are counted in a digest
+        self.notifier.notify(info['tag'], msg, build, disable_notification)
+
+    def notify_owner(self, message, filename, disable_notification = False):
+        if self.ownerID is None:
+            return
         if len(message)<=self.MAX_MSG_LEN:
-            self.bot.send_message(chat_id = self.ownerID, text = str(message), parse_mode = ParseMode.HTML, disable_notification = disable_notification)
-        else:
-            f = io.StringIO(message)
-            self.bot.send_document(chat_id= self.ownerID,
-                document= f,
-                filename= '{file_name}_{line_no}.html'.format_map(info),
-                caption= 'log of an unhandled exception')
-
-    def __get_content (self, tag):
-        if isinstance(tag, bs4.NavigableString):
-            return tag.string
+            self.delivery.send(lambda: self.bot.send_message(chat_id = self.ownerID, text = str(message), parse_mode = ParseMode.HTML, disable_notification = disable_notification))
         else:
-            return ''.join([str(c) for c in tag.contents])
-
-    def purge(self, html, images=True) -> Soup:
-        tags = self.SUPPORTED_HTML_TAGS
-        if images:
-            tags+='|img'
+            self.delivery.send(lambda: self.bot.send_document(chat_id= self.ownerID,
+                document= io.StringIO(message),
+                filename= filename,
+                caption= 'log of an unhandled exception',
+                disable_notification = disable_notification))
+
+    def purge(self, html, images=True, found=None) -> str:
+        '''Remove tags and attributes that telegram does not support, check Sanitizer.sanitize'''
+        return Sanitizer.sanitize(html, images, found)
+
+    def open_feeds(self, source, headers = None):
+        '''Open a request to the source, returns None if it was not modified
+
+        Failures are counted by the circuit breaker of the source, the next
+        check is scheduled by it instead of retrying here.'''
+        source.breaker.check(source.url)
+        self.logger.info(f'Getting feeds from {source.url}')
+        try:
+            response = self.http.get(source.url, headers, self.retry.timeout)
+            if response.status == 304 and not headers:
+                response.close()
+                raise Http.HttpError(f'{source.url} responded not modified to a request without validators', 304)
+        except Exception:
+            source.breaker.failure()
+            raise
+        source.breaker.success()
+        if response.status == 304:
+            response.close()
+            self.logger.info(f'Feeds of {source.url} not modified')
+            return None
+        return response
+
+    def conditional_headers(self, cache):
+        headers = dict()
+        if cache.get('etag'):
+            headers['If-None-Match'] = cache['etag']
+        if cache.get('last-modified'):
+            headers['If-Modified-Since'] = cache['last-modified']
+        return headers
+
+    def get_feeds(self, source, if_modified = False):
+        '''Return feeds page and whether it changed since the last check
+
+        ETag and Last-Modified validators are stored with the last page in
+        data_db, so an unchanged source costs a single 304 response.
+        `checked` remembers whether `check_new_feed` saw the stored page.'''
+        cache = self.get_data(source.key('feed-cache'), dict(), DB = self.data_db)
+        headers = self.conditional_headers(cache) if 'body' in cache else None
+        response = self.open_feeds(source, headers)
+        if response is None:
+            return self.feeds_not_modified(source, cache, if_modified)
+        with response as f:
+            body = f.read().decode('utf-8')
+            self.logger.info('Got feeds')
+            return self.feeds_modified(source, body, f.headers, if_modified)
+
+    def feeds_not_modified(self, source, cache, if_modified):
+        modified = not cache.get('checked')
+        if if_modified and modified:
+            cache['checked'] = True
+            self.set_data(source.key('feed-cache'), cache, DB = self.data_db)
+        return cache['body'], modified
+
+    def feeds_modified(self, source, body, headers, if_modified):
+        cache = {
+            'etag': headers.get('ETag'),
+            'last-modified': headers.get('Last-Modified')
+        }
+        if any(cache.values()):
+            cache['body'] = body
+            cache['checked'] = if_modified
+            self.set_data(source.key('feed-cache'), cache, DB = self.data_db)
+        return body, True
+
+    def stream_feeds(self, source, if_modified = False):
+        '''Return an iterator over feed elements of a streaming source
+
+        The response is parsed while it is being read, so closing the iterator
+        stops both reading and parsing. Only the validators are stored.'''
+        key = source.key('feed-cache')
+        headers = None
+        if if_modified:
+            headers = self.conditional_headers(self.get_data(key, dict(), DB = self.data_db))
+        response = self.open_feeds(source, headers)
+        if response is None:
+            return None
+        if if_modified:
+            self.set_data(key, {
+                'etag': response.headers.get('ETag'),
+                'last-modified': response.headers.get('Last-Modified')
+            }, DB = self.data_db)
+        return Feeds.iter_elements(response, source['feeds-selector'])
+
+    def summarize(self, html, max_length, read_more):
+        '''Cut html to `max_length` characters of text as telegram counts them, check Sanitizer.truncate'''
         if not isinstance(html, str):
             html = str(html)
-        pattern = r'</?(?!(?:%s)\b)\w+[^>]*/?>'%tags
-        purge = re.compile(pattern).sub      #This regex will purge any unsupported tag
-        soup = Soup(purge('', html), 'html.parser')
-        comments = soup.findAll(text=lambda text:isinstance(text, Comment))
-        for c in comments:
-            c.extract()
-        for tag in soup.descendants:
-            #Remove any unsupported attribute
-            if tag.name in self.SUPPORTED_TAG_ATTRS:
-                attr = self.SUPPORTED_TAG_ATTRS[tag.name]
-                if attr in tag.attrs:
-                    tag.attrs = {attr: tag[attr]}
-            else:
-                tag.attrs = dict()
-        return soup
+        return Sanitizer.truncate(html, max_length, read_more)
 
-    @retry(10)
-    def get_feeds(self):
-        self.logger.info('Getting feeds')
-        with urlopen(self.feed_configs['source']) as f:
-            self.logger.info('Got feeds')
-            return f.read().decode('utf-8')
-
-    def summarize(self, soup:Soup, max_length, read_more):
-        trim = len(read_more)
-        len_ = len(str(soup))
-        if len_>max_length:
-            trim += len_ - max_length
-            removed = 0
-            for element in reversed(list(soup.descendants)):
-                if (not element.name) and len(str(element))>trim-removed:
-                    s = str(element)
-                    wrap_index = s.rfind(' ',0 , trim-removed)
-                    if wrap_index == -1:
-                        element.replace_with(s[:-trim+removed])
-                        removed = trim
-                    else:
-                        element.replace_with(s[:wrap_index])
-                    removed = trim
-                else:
-                    element.replace_with('')
-                    removed += len(str(element))
-                if removed >= trim:
-                    break
-            soup.append(read_more)
-        return str(soup), len_>max_length
+    def room(self, message, limit):
+        'Characters that can be added to the text of a message'
+        return limit - Sanitizer.visible_length(message['text'])
 
     # in this version fead reader uses css selector to get feeds.
     # 
@@ -243,79 +299,79 @@ class BotHandler:
     #   - format: feed/{selector}, content/{selector}, title/{regex}, none
     # - remove-elements-selector: skip any element that has this attribute
 
-    def read_feed(self, index=0):
-        feeds_page = None
+    def parse_feeds(self, source, feeds_page):
+        if source.streaming:
+            return Feeds.iter_elements(io.BytesIO(feeds_page.encode('utf-8')), source['feeds-selector'])
+        soup_page = Soup(feeds_page, source.get('feed-format', 'xml'))
+        feeds_list = soup_page.select(source['feeds-selector'])
+        self.logger.info(f'Got {len(feeds_list)} feeds')
+        return feeds_list
+
+    def read_feed(self, index=0, if_modified=False, source=None, feeds_page=None):
+        '''Yield feeds of a source, `feeds_page` could be given if it is already downloaded'''
+        source = source or self.feeds[0]
+        feeds_list = None
         try:
-            feeds_page = self.get_feeds()
+            if feeds_page is not None:
+                feeds_list = self.parse_feeds(source, feeds_page)
+            elif source.streaming:
+                feeds_list = self.stream_feeds(source, if_modified)
+            else:
+                feeds_page, modified = self.get_feeds(source, if_modified)
+                if modified or not if_modified:
+                    feeds_list = self.parse_feeds(source, feeds_page)
+        except Retry.CircuitOpen as e:
+            self.logger.warning(str(e))
+            return
         except Exception as e:
             self.log_bug(e,'exception while trying to get last feed', False, True)
-            return None, None
-        
-        soup_page = Soup(feeds_page, self.feed_configs.get('feed-format', 'xml'))
-        feeds_list = soup_page.select(self.feed_configs['feeds-selector'])
-        self.logger.info(f'Got {len(feeds_list)} feeds')
-        title, link, content, time = None, None, None, None
-        for feed in feeds_list[index:]:
-            try:
-                if self.__skip_field == 'feed':
-                    if self.__skip(feed):
-                        continue    #skip this feed
-
-                title_selector = self.feed_configs['title-selector']
-                if title_selector:
-                    # title-selector could be None (null)
-                    if self.feed_configs['title-attribute']:
-                        title = str(feed.select_one(title_selector).attrs[self.feed_configs['title-attribute']])
-                    else:
-                        title = str(feed.select_one(title_selector).text)
-
-                    if self.__skip_field == 'title':
-                        if self.__skip(title):
-                            continue
-
-                link_selector = self.feed_configs['link-selector']
-                if link_selector:
-                    # link-selector could be None (null)
-                    if self.feed_configs['link-attribute']:
-                        link = str(feed.select_one(link_selector).attrs[self.feed_configs['link-attribute']])
-                    else:
-                        link = str(feed.select_one(link_selector).text)
-
-                    if self.__skip_field == 'link':
-                        if self.__skip(link):
-                            continue
-                
-                time_selector = self.feed_configs['time-selector']
-                # date-selector could not be None (null)
-                if self.feed_configs['time-attribute']:
-                    time = str(feed.select_one(time_selector).attrs[self.feed_configs['time-attribute']])
-                else:
-                    time = str(feed.select_one(time_selector).text)
+            return
 
-                if time is None:
-                    self.logger.error('The feed does not have a date, which means that the "date-selector" is not configured correctly')
-                    self.logger.info('The feed was\n'+str(feed))
-                
-                content_selector = self.feed_configs['content-selector']
-                if content_selector:
-                    content = Soup(self.__get_content(feed.select(content_selector)[0]),features="lxml")
+        if feeds_list is None:
+            return      #nothing changed since the last check
 
-                    if self.__skip_field == 'content':
-                        if self.__skip(content):
-                            continue
-                
+        feeds_list = islice(feeds_list, index, None)
+        while True:
+            # streamed feeds are read and parsed while they are iterated
+            try:
+                feed = next(feeds_list, None)
+            except Exception as e:
+                if isinstance(e, Http.HttpError):
+                    source.breaker.failure()
+                self.log_bug(e,'exception while trying to get last feed', False, True)
+                return
+            if feed is None:
+                return
+            try:
+                feed_data = source.plan(feed)
             except Exception as e:
                 self.log_bug(e,'Exception while reading feed', feed = str(feed))
                 break
-        
-            yield {
-                'title': title,
-                'link': link,
-                'content': content,
-                'date': time
-                }
-
-    def render_feed(self, feed: dict, header: str):
+            if feed_data is not None:
+                yield feed_data
+
+    def render_key(self, feed: dict, header: str, source):
+        '''Identity of a rendered feed, it changes with strings and remove-elements'''
+        if not (feed['link'] or feed['title']):
+            return None
+        identity = (source.url, feed['link'] or feed['title'], feed['date'], header, source.get('remove-elements'), self.strings_hash)
+        return hashlib.sha1(json.dumps(identity, ensure_ascii = False).encode()).hexdigest()
+
+    def render_feed(self, feed: dict, header: str, source=None):
+        '''Render a feed to a list of messages, rendered feeds are cached so the
+        returned list is shared and must not be changed by the caller'''
+        source = source or self.feeds[0]
+        key = self.render_key(feed, header, source)
+        messages = self.render_cache.get(key) if key else None
+        if messages is None:
+            messages = self.__render_feed(feed, header, source)
+            if key and messages is not None:
+                self.render_cache.put(key, messages)
+        else:
+            self.logger.debug(f'Rendered feed {feed["title"]} found in cache')
+        return messages
+
+    def __render_feed(self, feed: dict, header: str, source):
         title = feed['title']
         self.logger.debug(f'Rendering feed {title}')
         post_link = feed['link']
@@ -334,33 +390,35 @@ class BotHandler:
         try:
             if content:
                 #Remove elements with selector
-                remove_elem = self.feed_configs.get('remove-elements',[])
+                remove_elem = source.get('remove-elements',[])
                 for elem in remove_elem:
                     for e in content.select(elem):
                         e.extract()
-                content = self.purge(content)
-                images = content.find_all('img')
+                images = []
+                content = self.purge(content, found = images)
+                for img in images:
+                    if not img['src']:
+                        content = content.replace(img['markup'], '', 1)     # can not be sent as a photo
+                images = [img for img in images if img['src']]
+                content, images = self.check_images(content, images)
                 first = True
                 self.logger.debug(f'Found {len(images)} images')
 
                 if not len(images):
-                    content, overflow = self.summarize(content, self.MAX_MSG_LEN, self.get_string('read-more'))
+                    content, overflow = self.summarize(content, self.room(messages[0], self.MAX_MSG_LEN) - 1, self.get_string('read-more'))
                     messages[0]['text'] += '\n'+content
                 else:
-                    left, img_link, right = None, None, str(content)
-                    
+                    left, right = None, content
+
                     for img in images:
                         last_message = messages[-1]
-                        split_by = str(img)
-                        if img.parent.name == 'a':
-                            split_by = str(img.parent)
-                            img_link = img.parent['href']
-                        left, right = right.split(split_by, 1)
+                        img_link = img['link']
+                        left, right = Sanitizer.split(right, img['markup'])
 
                         if first:
                             if left:
                                 length = self.MAX_MSG_LEN if last_message['type'] == 'text' else self.MAX_CAP_LEN
-                                left, overflow = self.summarize(left, length, self.get_string('read-more'))
+                                left, overflow = self.summarize(left, self.room(last_message, length) - 1, self.get_string('read-more'))
                                 last_message['text'] += '\n'+left
                                 if right and not overflow:
                                     msg = {
@@ -380,7 +438,7 @@ class BotHandler:
                             first = False
                         else:
                             length = self.MAX_MSG_LEN if last_message['type'] == 'text' else self.MAX_CAP_LEN
-                            left, overflow = self.summarize(left, length, self.get_string('read-more'))
+                            left, overflow = self.summarize(left, self.room(last_message, length), self.get_string('read-more'))
                             last_message['text'] += left
                             if right and not overflow:
                                 msg = {
@@ -397,87 +455,293 @@ class BotHandler:
                     #End for img
                     if not overflow:
                         length = self.MAX_MSG_LEN if messages[-1]['type'] == 'text' else self.MAX_CAP_LEN
-                        right, overflow = self.summarize(right, length, self.get_string('read-more'))
+                        right, overflow = self.summarize(right, self.room(messages[-1], length), self.get_string('read-more'))
                         messages[-1]['text'] += right
                     
                 if post_link:
                     messages[-1]['markup'].append([InlineKeyboardButton(self.get_string('goto-post'), post_link)])
-            return messages
+            return self.group_images(messages)
         except Exception as e:
             self.log_bug(e,'Exception while rendering feed', feed = str(feed), messages = str(messages))
             return None
 
-    def send_feed(self, messages, chats):
+    def group_images(self, messages):
+        '''Merge consecutive images that have short captions and no buttons
+        into albums, that are sent with a single request'''
+        grouped = []
+        album = []
+
+        def close():
+            nonlocal album
+            if len(album) > 1:
+                grouped.append({'type': 'album', 'images': album, 'markup': []})
+            else:
+                grouped.extend(album)
+            album = []
+
+        for msg in messages:
+            if (msg['type'] == 'image' and not msg['markup'] and
+                    Sanitizer.visible_length(msg['text'] or '') <= self.MAX_ALBUM_CAPTION):
+                if len(album) == self.MAX_ALBUM_SIZE:
+                    close()
+                album.append(msg)
+            else:
+                close()
+                grouped.append(msg)
+        close()
+        return grouped
+
+    def check_images(self, content, images):
+        '''Probe images that were never sent at the same time. Images that
+        telegram can not send become links and tiny ones are removed'''
+        if self.image_prober is None or not images:
+            return content, images
+        results = self.image_prober.probe_all(
+            img['src'] for img in images if self.get_data(self.file_key(img['src']), DB = self.files_db) is None)
+        kept = []
+        for img in images:
+            result = results.get(img['src'])
+            if result is None or result['status'] == 'ok':
+                kept.append(img)
+                continue
+            self.logger.warning(f'Image {img["src"]} is not sent as a photo, {result["reason"]}')
+            link = ''
+            if result['status'] == 'bad':
+                link = html.escape(self.get_string('image-link'))
+                if not img['link'] or img['markup'].startswith('<a'):
+                    # not already inside a link
+                    link = f'<a href="{html.escape(img["link"] or img["src"])}">{link}</a>'
+            content = content.replace(img['markup'], link, 1)
+        return content, kept
+
+    def broadcast(self, kind, payload, source = None):
+        'Send payload to all chats (of source) with a job that survives restarts'
+        self.run_job(self.jobs.create(kind, payload, source.url if source else None))
+
+    def run_job(self, job):
+        source = None
+        if job.source is not None:
+            source = next((s for s in self.feeds if s.url == job.source), None)
+            if source is None:
+                self.logger.warning(f'Source of broadcast job {job.id} is removed, {job.source}')
+                self.jobs.finish(job)
+                return
+        self.jobs.run(job, self.iter_all_chats(source, after = job.cursor))
+
+    def resume_jobs(self):
+        for job in self.jobs.unfinished():
+            self.logger.info(f'Resuming broadcast job {job.id} after {job.chats} chats')
+            Thread(target = self.run_job, args = (job,), name = f'job-{job.id}', daemon = True).start()
+
+    def deliver_feed(self, messages, chats, job = None):
+        if job is not None and (job.shards or self.shards.processes > 1 and not self.runtime):
+            return self.send_feed_sharded(messages, job)
+        if self.runtime:
+            return self.runtime.send_feed_threadsafe(messages, chats, job)
+        else:
+            self.send_feed(messages, chats, job)
+
+    def file_key(self, src):
+        'Key of an image in files_db, urls that are longer than a lmdb key are hashed'
+        if len(src.encode()) <= self.env.max_key_size():
+            return src
+        return 'sha1:' + hashlib.sha1(src.encode()).hexdigest()
+
+    def stored_file_ids(self, messages):
+        'Stored file_ids of the images of messages (src => file_id), images without one are uploaded by the first chat'
+        file_ids = dict()
+        for msg in messages:
+            for img in Delivery.images_of(msg):
+                if img['src'] not in file_ids:
+                    file_id = self.get_data(self.file_key(img['src']), DB = self.files_db)
+                    if file_id:
+                        file_ids[img['src']] = file_id
+        return file_ids
+
+    def send_feed_sharded(self, messages, job):
+        '''Send a feed from a process for each shard of chats, check Shards.
+        Returns False if a process stopped before its shard was done.'''
+        if job.shards is None:
+            job.shards = self.shards.processes
+            self.jobs.save(job)
+        elif job.shards != self.shards.processes:
+            self.logger.info(f'Broadcast job {job.id} is sent by {job.shards} processes like before')
+        source = next((s for s in self.feeds if s.url == job.source), None)
+        file_ids = self.stored_file_ids(messages)
+        stats = {'chats': 0, 'messages': 0, 'failed': 0}
+        crashed = 0
+        start = time.monotonic()
+        for result in self.shards.broadcast(job, messages, file_ids, source.subscribers if source else None):
+            kind = result[0]
+            if kind == 'progress':
+                job.complete_shard(*result[1:])
+            elif kind == 'blocked':
+                self.delete_chat(result[1], batch = True)
+            elif kind == 'failed':
+                chat_id, tag, tb_string = result[1:]
+                self.logger.error(f'Exception while sending a feed to {chat_id}\n{tb_string}')
+                self.notifier.notify(tag, 'Exception while sending a feed to a user', lambda: (
+                    '<b>An exception was raised in a sender process</b>\n'
+                    f'<i>{html.escape(tag)}</i>\nchat_id = {html.escape(chat_id)}\n\n<pre>{html.escape(tb_string)}</pre>',
+                    'sender.html'))
+            elif kind == 'file':
+                self.set_data(self.file_key(result[1]), result[2], DB = self.files_db, batch = True)
+            elif kind == 'bad-file':
+                self.delete_data(self.file_key(result[1]), DB = self.files_db, batch = True)
+            elif kind == 'done':
+                for key in stats:
+                    stats[key] += result[2][key]
+            elif kind == 'crashed':
+                crashed += 1
+                self.logger.error(f'Sender process of shard {result[1]} stopped with exit code {result[2]}')
+        self.writes.flush()
+        elapsed = time.monotonic() - start
+        self.logger.info(
+            f'Delivered {stats["messages"]} messages to {stats["chats"]} chats from {job.shards} processes '
+            f'in {elapsed:.1f}s ({stats["messages"] / elapsed if elapsed else 0:.1f} msg/s, {stats["failed"]} failed)')
+        return not crashed
+
+    def send_feed(self, messages, chats, job = None):
         deathlist = [] #Delete IDs that are no longer available
+        file_ids = self.stored_file_ids(messages)
+
+        def stored(src, file_id):
+            if file_id:
+                self.set_data(self.file_key(src), file_id, DB = self.files_db, batch = True)
+            else:
+                self.delete_data(self.file_key(src), DB = self.files_db, batch = True)
+
+        def blocked(chat_id, chat_data, e):
+            self.log_bug(e,'handled an exception while sending a feed to a user. removing chat', report=False, chat_id = chat_id, chat_data = chat_data)
+            deathlist.append(chat_id)
+
+        def failed(chat_id, chat_data, msg, e):
+            self.log_bug(e, 'Exception while sending a feed to a user', message = msg, chat_id = chat_id, chat_data = chat_data)
+
+        sender = Delivery.FeedSender(messages, file_ids, lambda template, chat_id: Delivery.post(self.bot, template, chat_id), stored, blocked, failed)
         try:
-            for chat_id, chat_data in chats:
-                for msg in messages:
-                    try:
-                        if msg['type'] == 'text':
-                            self.bot.send_message(
-                                chat_id,
-                                msg['text'],
-                                parse_mode = ParseMode.HTML,
-                                reply_markup = InlineKeyboardMarkup(msg['markup']) if msg['markup'] else None,
-                                disable_web_page_preview = True
-                            )
-                        elif msg['type'] == 'image':
-                            if msg['text'] == '':
-                                msg['text'] = None
-                            self.bot.send_photo(
-                                chat_id,
-                                msg['src'],
-                                msg['text'],
-                                parse_mode = ParseMode.HTML,
-                                reply_markup = InlineKeyboardMarkup(msg['markup']) if msg['markup'] else None
-                            )
-                    except Unauthorized as e:
-                        self.log_bug(e,'handled an exception while sending a feed to a user. removing chat', report=False, chat_id = chat_id, chat_data = chat_data)
-                        deathlist.append(chat_id)
-                        break
-                    except Exception as e:
-                        self.log_bug(e, 'Exception while sending a feed to a user', message = msg, chat_id = chat_id, chat_data = chat_data)
-                        break
+            self.delivery.broadcast(chats, sender.deliver, job)
         except Exception as e:
             self.log_bug(e,'Exception while trying to send feed', messages = messages)
 
         for chat_id in deathlist:
-            with self.env.begin(self.chats_db, write = True) as txn:
-                txn.delete(str(chat_id).encode())
+            self.delete_chat(chat_id, batch = True)
+        self.writes.flush()
 
-    def iter_all_chats(self):
+    def iter_all_chats(self, source=None, full=False, after=None):
+        '''Yield (chat_id, chat_data) of all chats in the order of their ids, or
+        chats after `after`. chat_data only has id, type and members-count
+        unless `full` is True'''
         deathlist = []
-        with env.begin(self.chats_db) as txn:
-            for key, value in txn.cursor():
-                data = pickle.loads(value)
-                if not isinstance(data,dict):
+        decode = Chats.decode if full else Chats.decode_header
+        with self.env.begin(self.chats_db) as txn:
+            cursor = txn.cursor()
+            found = cursor.set_range(after.encode()) if after is not None else cursor.first()
+            for key, value in (cursor if found else ()):
+                if after is not None and key.decode() <= after:
+                    continue
+                if source and not source.is_subscriber(key.decode()):
+                    continue
+                try:
+                    data = decode(value)
+                except Exception as e:
                     deathlist.append(key)
-                    self.log_bug(ValueError('chat data is not a dict'), 'chat data is not a dict', data = data)
+                    self.log_bug(e, 'bad chat record', chat_id = key.decode())
                     continue
                 yield key.decode(), data
-        with env.begin(self.chats_db, write = True) as txn:
-            for key in deathlist:
-                txn.delete(key.encode())
-
-    def check_new_feed(self):
-        last_date = self.get_data('last-feed-date', DB = self.data_db)
+        for key in deathlist:
+            self.delete_chat(key, batch = True)
+        self.writes.flush()
+
+    def get_chat(self, chat_id):
+        return self.get_data(str(chat_id), DB = self.chats_db, do = Chats.decode)
+
+    def set_chat(self, chat_id, data):
+        key, value = str(chat_id).encode(), Chats.encode(data)
+        with self.env.begin(write = True) as txn:
+            old = txn.get(key, db = self.chats_db)
+            txn.put(key, value, db = self.chats_db)
+            self.__update_stats(txn, old, value)
+
+    def delete_chat(self, chat_id, batch = False):
+        '''Delete a chat, with `batch` it is deleted on the next flush of writes'''
+        key = chat_id if isinstance(chat_id, bytes) else str(chat_id).encode()
+        if batch:
+            self.writes.add(lambda txn: self.__delete_chat(txn, key))
+            return None
+        with self.env.begin(write = True) as txn:
+            return self.__delete_chat(txn, key)
+
+    def __delete_chat(self, txn, key):
+        old = txn.pop(key, db = self.chats_db)
+        if old is not None:
+            self.__update_stats(txn, old)
+        return old is not None
+
+    def __update_stats(self, txn, old = None, new = None):
+        stats = Chats.get_stats(txn, self.data_db) or Chats.empty_stats()
+        Chats.put_stats(txn, self.data_db, Chats.update_stats(stats, old, new))
+
+    def chat_stats(self):
+        '''Number of chats, members and chats of each type'''
+        with self.env.begin(self.data_db) as txn:
+            return Chats.get_stats(txn, self.data_db) or Chats.empty_stats()
+
+    def last_feed_date(self, source):
+        last_date = self.get_data(source.key('last-feed-date'), DB = self.data_db)
+        if last_date is None and source is self.feeds[0]:
+            # stored by older versions that had a single source
+            last_date = self.get_data('last-feed-date', DB = self.data_db)
+        return last_date
+
+    def last_feed(self, source):
+        '''Latest feed of a source, from memory if it is fresh enough'''
+        return self.latest_feeds[source.url].get()
+
+    def check_new_feed(self, source, feeds_page = None):
+        last_date = self.last_feed_date(source)
         new_date = last_date
-        for feed in self.read_feed():
+        first_check = self.seen.is_empty(source)
+        feeds = []
+        for i, feed in enumerate(self.read_feed(if_modified = True, source = source, feeds_page = feeds_page)):
+            if i == 0:
+                self.latest_feeds[source.url].set(feed)
             date = parse_date(feed['date']) if feed['date'] else None
-            if date is None or last_date is not None and last_date < date:
-                new_date = max(date, new_date)
-                self.logger.info(f'Sending new feed. date: {date}')
-                messages = self.render_feed(feed, header= self.get_string('new-feed'))
-                self.send_feed(messages, self.iter_all_chats())
-            if date is None or last_date is None or date <= last_date:
-                self.logger.info('No more new feeds')
-                break
-        self.set_data('last-feed-date', new_date, DB = self.data_db)
-        if self.__check:
-            self.logger.info(f'Checking for new feeds in {self.interval} seconds')
-            self.check_thread = Timer(self.interval, self.check_new_feed)
-            self.check_thread.start()
-
+            if date is not None and (new_date is None or new_date < date):
+                new_date = date
+            fingerprint = Feeds.fingerprint(feed)
+            last_seen = self.seen.last_seen(source, fingerprint)
+            feeds.append((feed, date, fingerprint, last_seen))
+            if last_seen is not None and source.streaming:
+                break       # the rest was seen before
+        if not feeds:
+            return
+
+        # if no feed of the page was seen, this is the first check of the source
+        # or its links have changed, only feeds that are newer by date are sent
+        known = any(last_seen is not None for feed, date, fingerprint, last_seen in feeds)
+        by_date = first_check or not known and len(feeds) > 1
+        now = time.time()
+        for feed, date, fingerprint, last_seen in feeds:
+            if last_seen is not None:
+                continue
+            if by_date and (date is None or last_date is None or date <= last_date):
+                continue
+            self.logger.info(f'Sending new feed from {source.url}. date: {date}')
+            messages = self.render_feed(feed, header= self.get_string('new-feed'), source = source)
+            if messages is None:
+                continue
+            # the feed is seen as soon as its broadcast is stored
+            with self.env.begin(write = True) as txn:
+                job = self.jobs.create('feed', messages, source.url, txn)
+                self.seen.add(source, [fingerprint], now, txn)
+            self.run_job(job)
+        # feeds that are still in the page are renewed before they get too old
+        self.seen.add(source, [
+            fingerprint for feed, date, fingerprint, last_seen in feeds
+            if last_seen is None or now - last_seen > self.seen.max_age / 2], now)
+        self.seen.evict(source, now)
+        self.set_data(source.key('last-feed-date'), new_date, DB = self.data_db)
 
     def get_data(self, key, default = None, DB = None, do = lambda data: pickle.loads(data)):
         DB = DB if DB else self.chats_db
@@ -489,29 +753,72 @@ class BotHandler:
         else:
             return data
 
-    def set_data(self, key, value, DB = None, over_write = True, do = lambda data: pickle.dumps(data)):
+    def set_data(self, key, value, DB = None, over_write = True, do = lambda data: pickle.dumps(data), batch = False):
         DB = DB if DB else self.chats_db
         if not callable(do):
             do = lambda data: data
+        if batch:
+            value = do(value)
+            self.writes.add(lambda txn: txn.put(key.encode(), value, overwrite = over_write, db = DB))
+            return None
         with self.env.begin(DB, write = True) as txn:
             return txn.put(key.encode(), do(value), overwrite = over_write)
 
+    def delete_data(self, key, DB = None, batch = False):
+        DB = DB if DB else self.chats_db
+        if batch:
+            self.writes.add(lambda txn: txn.delete(key.encode(), db = DB))
+            return None
+        with self.env.begin(DB, write = True) as txn:
+            return txn.delete(key.encode())
+
     def get_string(self, string_name):
         return ''.join(self.strings[string_name])
 
+    def reschedule(self):
+        '''Apply a new interval to waiting checks'''
+        if self.runtime:
+            self.runtime.reschedule()
+        else:
+            self.scheduler.reschedule()
+
     def run(self):
-        self.updater.start_polling()
-        # check for new feed
-        self.check_new_feed()
+        if self.runtime:
+            # polling, feed checks and broadcasts on an event loop, it raises
+            # before starting if the proxy is not supported
+            self.runtime.start(self.feeds, polling = self.webhook is None)
+            if self.webhook:
+                self.webhook.start()
+            self.resume_jobs()
+            return
+        if self.webhook:
+            self.webhook.start()
+            # updates come from the webhook, only the dispatcher is needed
+            self.dispatcher_thread = Thread(target = self.dispatcher.start, name = 'dispatcher')
+            self.dispatcher_thread.start()
+        else:
+            self.updater.start_polling()
+        self.resume_jobs()
+        # check all sources for new feeds
+        self.scheduler.start(self.feeds)
 
     def idle(self):
-        self.updater.idle()
-        self.updater.stop()
-        self.__check = False
-        self.check_thread.cancel()
-        if self.check_thread.is_alive():
-            print('waiting for check thread to finish')
-            self.check_thread.join()
+        if self.runtime:
+            self.runtime.idle()
+        else:
+            if self.webhook:
+                Webhook.wait_for_signal()
+                self.dispatcher.stop()
+                self.dispatcher_thread.join()
+            else:
+                self.updater.idle()
+                self.updater.stop()
+            print('waiting for feed checks to finish')
+            self.scheduler.stop()
+        if self.webhook:
+            self.webhook.stop()
+        self.writes.close()
+        self.notifier.stop()
 
 
 if __name__ == '__main__':
@@ -528,6 +835,10 @@ if __name__ == '__main__':
     help='Specify config file',
     default='user-config.jsonc', required=False, type=argparse.FileType('r'))
 
+    parser.add_argument('--rebuild-stats',
+    help='Count chats and members again, use it if /state shows wrong numbers',
+    action='store_true', default=False, required=False)
+
     args = parser.parse_args(sys.argv[1:])
     config = dict()
     with args.config as cf:
@@ -543,7 +854,7 @@ if __name__ == '__main__':
         format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         filename=log_file_name,
         level = logging._nameToLevel.get(config.get('log-level','INFO').upper(),logging.INFO))
-    env = lmdb.open(config.get('db-path','db.lmdb'), max_dbs = 3)
+    env = lmdb.open(config.get('db-path','db.lmdb'), map_size = config.get('db-map-size', Storage.MAP_SIZE), max_dbs = 8)
     chats_db = env.open_db(b'chats')
     data_db = env.open_db(b'config')        #using old name for compatibility
 
@@ -563,6 +874,10 @@ if __name__ == '__main__':
             print('Reset done. now you can run the bot again')
             sys.exit()
 
+    if args.rebuild_stats:
+        stats = Chats.rebuild_stats(env, chats_db, data_db)
+        print(f'Stats rebuilt. chats: {stats["chats"]}, members: {stats["members"]}')
+
     language = config.get('language','en-us')
     strings_file = config.get('strings-file', 'default-strings.json')
     checks=[
@@ -632,7 +947,19 @@ if __name__ == '__main__':
     if use_proxy:
         proxy_info = config.get('proxy-info')
 
-    bot_handler = BotHandler(token, config.get('feed-configs'), env, chats_db, data_db, strings, bug_reporter_config != 'off', debug, proxy_info)
+    bot_handler = BotHandler(token, config.get('feed-configs'), env, chats_db, data_db, strings, bug_reporter_config != 'off', debug, proxy_info,
+        delivery_configs = config.get('delivery'),
+        feed_workers = config.get('feed-workers', 4),
+        render_cache_configs = config.get('render-cache'),
+        last_feed_ttl = config.get('last-feed-ttl', 300),
+        write_batch_configs = config.get('write-batch'),
+        runtime = config.get('runtime', 'threads'),
+        webhook_configs = config.get('webhook'),
+        seen_max_age = config.get('seen-feeds-max-age', 30),
+        notifier_configs = config.get('owner-notifications'),
+        retry_configs = config.get('feed-retry'),
+        image_probe_configs = config.get('image-probe'),
+        http_configs = config.get('http-client'))
     bot_handler.run()
     bot_handler.idle()
     if bug_reporter_config != 'off':
@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import Sanitizer
+
+
+class SanitizeTest(unittest.TestCase):
+
+    def test_unfinished_tag_is_text(self):
+        self.assertEqual(Sanitizer.sanitize('if x<y &amp; z is true'), 'if x&lt;y &amp; z is true')
+        self.assertEqual(Sanitizer.sanitize('<p>a<b &amp; c</p>'), 'a&lt;b &amp; c')
+        self.assertEqual(Sanitizer.sanitize('<!&amp;'), '&lt;!&amp;')
+        self.assertEqual(Sanitizer.sanitize('<?&lt;'), '&lt;?&lt;')
+
+    def test_unfinished_references(self):
+        self.assertEqual(Sanitizer.sanitize('&nbsp-'), '\xa0-')
+        self.assertEqual(Sanitizer.sanitize('&#q &#z <b>;</b>'), '&amp;#q &amp;#z &lt;b&gt;;&lt;/b&gt;')
+
+    def test_comments_and_declarations(self):
+        self.assertEqual(Sanitizer.sanitize('<!--> a'), '&lt;!--&gt; a')
+        self.assertEqual(Sanitizer.sanitize('<?>'), '<? >')
+        self.assertEqual(Sanitizer.sanitize('<pre><!></pre>'), '<pre><!----></pre>')
+
+
+class SplitTest(unittest.TestCase):
+
+    def split_images(self, html):
+        images = []
+        rest = Sanitizer.sanitize(html, found=images)
+        pieces = []
+        for img in images:
+            left, rest = Sanitizer.split(rest, img['markup'])
+            pieces.append(left)
+        return pieces + [rest], images
+
+    def test_two_images_in_one_link(self):
+        pieces, images = self.split_images('<a href="http://l"><img src="1"/>cap1<img src="2"/></a> tail')
+        self.assertEqual([img['link'] for img in images], ['http://l', 'http://l'])
+        self.assertEqual(pieces, ['', '<a href="http://l">cap1</a>', ' tail'])
+
+    def test_nested_tags_are_reopened(self):
+        pieces, images = self.split_images('<b>x<a href="http://l">y<img src="1"/>z<img src="2"/></a>w</b>')
+        self.assertEqual(pieces, [
+            '<b>x<a href="http://l">y</a></b>',
+            '<b><a href="http://l">z</a></b>',
+            '<b>w</b>'])
+
+    def test_single_image_link_is_removed(self):
+        pieces, images = self.split_images('a<a href="http://l"><img src="1"/></a>b')
+        self.assertEqual(images[0]['markup'], '<a href="http://l"><img src="1"/></a>')
+        self.assertEqual(pieces, ['a', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+'''Send recorded updates to the webhook of the bot and report latencies
+
+Updates are read from a json file (a list of updates) or a jsonl file (one
+update per line), e.g. updates that were saved from getUpdates.
+
+    python3 webhook_replay.py updates.jsonl http://127.0.0.1:8443/ --secret-token SECRET --concurrency 32
+'''
+import argparse
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from Webhook import SECRET_HEADER
+
+
+def load_updates(path):
+    with open(path, encoding='utf-8') as f:
+        text = f.read().strip()
+    if text.startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def post(url, update, secret_token=None):
+    headers = {'Content-Type': 'application/json'}
+    if secret_token:
+        headers[SECRET_HEADER] = secret_token
+    request = Request(url, json.dumps(update).encode(), headers)
+    start = time.perf_counter()
+    try:
+        with urlopen(request, timeout=30) as response:
+            status = response.status
+    except HTTPError as e:
+        status = e.code
+    except OSError:
+        status = None
+    return status, time.perf_counter() - start
+
+
+def replay(updates, url, secret_token=None, concurrency=1, repeat=1):
+    updates = updates * repeat
+    with ThreadPoolExecutor(concurrency) as executor:
+        start = time.perf_counter()
+        results = list(executor.map(lambda u: post(url, u, secret_token), updates))
+        elapsed = time.perf_counter() - start
+    latencies = sorted(latency for status, latency in results)
+    failed = sum(1 for status, latency in results if status != 200)
+    return {
+        'updates': len(results),
+        'failed': failed,
+        'elapsed': elapsed,
+        'rate': len(results) / elapsed if elapsed else 0,
+        'p50': statistics.median(latencies) * 1000 if latencies else 0,
+        'p95': latencies[int(len(latencies) * 0.95) - 1] * 1000 if latencies else 0,
+        'max': latencies[-1] * 1000 if latencies else 0
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Send recorded updates to a webhook')
+    parser.add_argument('updates', help='json or jsonl file of updates')
+    parser.add_argument('url', help='url of the webhook like http://127.0.0.1:8443/')
+    parser.add_argument('--secret-token', default=None)
+    parser.add_argument('--concurrency', type=int, default=1, help='updates that are sent at the same time')
+    parser.add_argument('--repeat', type=int, default=1, help='send all updates this many times')
+    args = parser.parse_args()
+
+    result = replay(load_updates(args.updates), args.url, args.secret_token, args.concurrency, args.repeat)
+    print('{updates} updates in {elapsed:.2f}s ({rate:.1f}/s), {failed} failed\n'
+          'latency: p50 {p50:.1f}ms, p95 {p95:.1f}ms, max {max:.1f}ms'.format_map(result))